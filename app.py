@@ -2,17 +2,57 @@ import time
 import os
 import sys
 from collections import defaultdict
+from datetime import datetime, timezone
+from decimal import Decimal
+from bson import ObjectId
+from bson.decimal128 import Decimal128
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, CallbackQueryHandler, MessageHandler, filters, ContextTypes
-from database import get_user, update_user, create_user_if_not_exists, add_transaction, get_transactions
+from telegram.ext import Application, CommandHandler, CallbackQueryHandler, MessageHandler, TypeHandler, filters, \
+    ContextTypes
+from async_database import create_user_if_not_exists, get_balances, withdraw, \
+    get_transaction_page, add_payment_method, get_payment_methods, get_payment_method
+from database import FIAT_METHODS, WITHDRAW_INSUFFICIENT, WITHDRAW_OK, UnitOfWork, close_client, ensure_indexes, \
+    verify_index_usage, warm_up
+import money
+import async_database
+from state_store import state_store
+from router import Router
+from invalidation import CacheInvalidator
+from concurrency import FloodLimiter, PerUserUpdateProcessor
+from keyboards import build_menu, payment_method_keyboards
+import keyboards
+from metrics import track_handler, track_startup, record_handler_error, stats_text
+import metrics
+from cluster import BOT_MODE, WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_URL, WEBHOOK_INTERNAL_URL, \
+    WEBHOOK_SECRET, PollerLease, ShardCoordinator, wait_for_poller_lease
 
 start_time = time.time()
 
 TELEGRAM_TOKEN = os.getenv('TELEGRAM_TOKEN')
-if not TELEGRAM_TOKEN:
-    raise ValueError(
-        "Telegram token not found. Please ensure the TELEGRAM_TOKEN environment variable is correctly set."
-    )
+MONGO_INDEX_SELF_CHECK = os.getenv('MONGO_INDEX_SELF_CHECK', '1') == '1'
+STARTUP_BUDGET = float(os.getenv('STARTUP_BUDGET', '10'))
+
+cluster_member = ShardCoordinator() if BOT_MODE == 'webhook' else PollerLease()
+metrics_server = None
+
+
+def invalidate_user(user_id):
+    state_store.invalidate(user_id)
+    payment_method_keyboards.invalidate(user_id)
+
+
+def invalidate_all_users():
+    state_store.invalidate_all()
+    payment_method_keyboards.clear()
+
+
+cache_invalidator = CacheInvalidator(invalidate_user, invalidate_all_users)
+restart_requested = False
+standby_seconds = 0.0
+
+
+router = Router()
+FLOWS = {'deposit', 'withdraw'}
 
 
 def get_uptime():
@@ -20,18 +60,8 @@ def get_uptime():
     return elapsed_time
 
 
-def build_menu(buttons, n_cols):
-    return [buttons[i:i + n_cols] for i in range(0, len(buttons), n_cols)]
-
-
 async def show_main_menu(update_or_query, context):
-    keyboard = [
-        InlineKeyboardButton("Check Balance", callback_data='check_balance'),
-        InlineKeyboardButton("Deposit", callback_data='deposit'),
-        InlineKeyboardButton("Withdraw", callback_data='withdraw'),
-        InlineKeyboardButton('Cancel', callback_data='cancel')
-    ]
-    reply_markup = InlineKeyboardMarkup(build_menu(keyboard, 1))
+    reply_markup = keyboards.MAIN_MENU
     if isinstance(update_or_query, Update):
         await update_or_query.message.reply_text('Welcome to Deeper Systems! Choose an option:',
                                                  reply_markup=reply_markup)
@@ -39,17 +69,15 @@ async def show_main_menu(update_or_query, context):
         await update_or_query.edit_message_text('Choose an option:', reply_markup=reply_markup)
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    user_id = update.effective_user.id
-    create_user_if_not_exists(user_id)
-    await show_main_menu(update, context)
+    with track_handler("start"):
+        user_id = update.effective_user.id
+        await create_user_if_not_exists(user_id)
+        await show_main_menu(update, context)
 
 
-def add_unique_method(user_id, method):
-    user = get_user(user_id)
-    methods = user.get('deposit_methods', [])
-    if not any(m['type'] == method['type'] and m.get('crypto_type') == method.get('crypto_type') and m['details'] ==
-               method['details'] for m in methods):
-        update_user(user_id, {"$push": {"deposit_methods": method}})
+async def add_unique_method(user_id, method_type, details, crypto_type=None):
+    if await add_payment_method(user_id, method_type, details, crypto_type):
+        payment_method_keyboards.invalidate(user_id)
 
 
 async def debug_uptime(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -58,70 +86,60 @@ async def debug_uptime(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     await update.message.reply_text(uptime_message)
 
 
-def calculate_detailed_balance(user_id):
-    try:
-        transactions = get_transactions(user_id)
-        fiat_balance = 0.0
-        crypto_balances = defaultdict(float)
-
-        for transaction in transactions:
-            if not all(k in transaction for k in ["transaction_type", "amount", "method"]):
-                continue
-
-            transaction_type = transaction["transaction_type"]
-            value = float(transaction["amount"])
-            method = transaction["method"]
-
-            if transaction_type == "deposit":
-                if method in ["bank_transfer", "paypal"]:
-                    fiat_balance += value
-                elif method == "crypto":
-                    crypto_balances[transaction.get("currency", "unknown")] += value
-
-            elif transaction_type == "withdraw":
-                if method in ["bank_transfer", "paypal"]:
-                    fiat_balance -= value
-                elif method == "crypto":
-                    crypto_balances[transaction.get("currency", "unknown")] -= value
-
-        total_balance = fiat_balance + sum(crypto_balances.values())
-
-        return {
-            "fiat_balance": fiat_balance,
-            "crypto_balances": dict(crypto_balances),
-            "total_balance": total_balance
-        }
-    except Exception as e:
-        raise e
+async def debug_stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    await update.message.reply_text(stats_text())
+
+
+async def calculate_detailed_balance(user_id):
+    balances = await get_balances(user_id)
+    fiat_balance = Decimal(0)
+    crypto_balances = defaultdict(Decimal)
+
+    for method, currencies in balances.items():
+        for currency, value in currencies.items():
+            if method in FIAT_METHODS:
+                fiat_balance += money.from_minor(currency, value)
+            elif method == "crypto":
+                crypto_balances[currency] += money.from_minor(currency, value)
+
+    # One rate lookup values the fiat balance and every crypto holding.
+    holdings = [{money.BASE_CURRENCY: fiat_balance}] + [{currency: amount} for currency, amount in crypto_balances.items()]
+    # A provider may fetch the rates over the network; keep that off the event loop.
+    rates = await async_database.run_db(money.rate_cache.rates)
+    values = money.value_holdings(holdings, rates=rates)
+    crypto_values = {currency: value for currency, value in zip(crypto_balances, values[1:])}
+
+    return {
+        "fiat_balance": fiat_balance,
+        "crypto_balances": dict(crypto_balances),
+        "crypto_values": {currency: total for currency, (total, unpriced) in crypto_values.items() if not unpriced},
+        "total_balance": sum(total for total, unpriced in values)
+    }
 
 
 async def show_user_balance(update_or_query, context, user_id):
     try:
-        balance_details = calculate_detailed_balance(user_id)
+        balance_details = await calculate_detailed_balance(user_id)
         fiat_balance = balance_details["fiat_balance"]
         crypto_balances = balance_details["crypto_balances"]
+        crypto_values = balance_details["crypto_values"]
         total_balance = balance_details["total_balance"]
 
         balance_message = f"Fiat Balance (Bank & PayPal): ${fiat_balance:.2f}\n\nCrypto Balances:\n"
         for crypto_type, amount in crypto_balances.items():
-            balance_message += f"- {crypto_type}: {amount:.2f}\n"
+            balance_message += f"- {crypto_type}: {money.format_amount(crypto_type, amount)}"
+            if crypto_type in crypto_values:
+                balance_message += f" (≈ ${crypto_values[crypto_type]:.2f})"
+            else:
+                balance_message += " (no rate available)"
+            balance_message += "\n"
 
-        balance_message += f"\nTotal Balance: ${total_balance:.2f}"
+        balance_message += f"\nTotal Balance: ≈ ${total_balance:.2f}"
 
         if isinstance(update_or_query, Update):
-            await update_or_query.message.reply_text(
-                text=balance_message,
-                reply_markup=InlineKeyboardMarkup(
-                    build_menu([InlineKeyboardButton("Back to Main Menu", callback_data='back_to_menu')], 1)
-                )
-            )
+            await update_or_query.message.reply_text(text=balance_message, reply_markup=keyboards.BACK_TO_MENU)
         else:
-            await update_or_query.edit_message_text(
-                text=balance_message,
-                reply_markup=InlineKeyboardMarkup(
-                    build_menu([InlineKeyboardButton("Back to Main Menu", callback_data='back_to_menu')], 1)
-                )
-            )
+            await update_or_query.edit_message_text(text=balance_message, reply_markup=keyboards.BACK_TO_MENU)
     except Exception as e:
         print(f"Error in show_user_balance: {e}")
         if isinstance(update_or_query, Update):
@@ -131,17 +149,9 @@ async def show_user_balance(update_or_query, context, user_id):
 
 
 async def show_payment_methods(update_or_query, context, user_id):
-    user = get_user(user_id)
-    methods = user.get("deposit_methods", [])
-
-    buttons = [
-        InlineKeyboardButton(f"{method['type']} ({method.get('details', '')})",
-                             callback_data=f"use_method_{method['type']}_{i}")
-        for i, method in enumerate(methods)
-    ]
-    buttons.append(InlineKeyboardButton("Add Payment Method", callback_data='add_payment_method'))
-    buttons.append(InlineKeyboardButton("Cancel", callback_data='cancel'))
-    reply_markup = InlineKeyboardMarkup(build_menu(buttons, 1))
+    reply_markup = payment_method_keyboards.get(user_id)
+    if reply_markup is None:
+        reply_markup = payment_method_keyboards.build(user_id, await get_payment_methods(user_id))
 
     if isinstance(update_or_query, Update):
         await update_or_query.message.reply_text("Select a payment method:", reply_markup=reply_markup)
@@ -149,264 +159,401 @@ async def show_payment_methods(update_or_query, context, user_id):
         await update_or_query.edit_message_text("Select a payment method:", reply_markup=reply_markup)
 
 
+def idempotency_key(query):
+    # Every tap on the same confirmation message maps to the same key, so double
+    # taps and redelivered callbacks post the transaction only once.
+    if query.message:
+        return f"{query.message.chat.id}:{query.message.message_id}"
+    return f"callback:{query.id}"
+
+
+def history_amount(row):
+    if "amount_minor" in row:
+        return money.format_amount(row["currency"], money.from_minor(row["currency"], row["amount_minor"]))
+    amount = row["amount"]
+    return amount.to_decimal() if isinstance(amount, Decimal128) else amount
+
+
+def history_callback(direction, row):
+    return f"history_{direction}_{row['timestamp']!r}_{row['_id']}"
+
+
+async def show_history(query, context, user_id, cursor=None, newer=False):
+    rows, has_older, has_newer = await get_transaction_page(user_id, cursor, newer)
+
+    if rows:
+        lines = []
+        for row in rows:
+            when = datetime.fromtimestamp(row["timestamp"], timezone.utc).strftime("%Y-%m-%d %H:%M")
+            sign = "-" if row["transaction_type"] == "withdraw" else "+"
+            lines.append(f"{when} {row['transaction_type']} {sign}{history_amount(row)} {row['currency']} "
+                         f"({row['method']})")
+        text = "Transaction history (newest first):\n\n" + "\n".join(lines)
+    else:
+        text = "No transactions yet."
+
+    navigation = []
+    if rows and has_newer:
+        navigation.append(InlineKeyboardButton("« Newer", callback_data=history_callback('newer', rows[0])))
+    if rows and has_older:
+        navigation.append(InlineKeyboardButton("Older »", callback_data=history_callback('older', rows[-1])))
+    keyboard = build_menu(navigation, 2) + [[keyboards.BACK_TO_MENU_BUTTON]]
+    await query.edit_message_text(text=text, reply_markup=InlineKeyboardMarkup(keyboard))
+
+
+def transaction_currency(state):
+    if state.get("selected_method_type") == 'crypto':
+        return state.get("selected_crypto_type", "").upper()
+    return money.BASE_CURRENCY
+
+
 def validate_transaction_data(state):
     flow = state.get("flow")
     amount = state.get("amount")
     method = state.get("selected_method_type")
 
-    if not flow or amount is None or not method:
+    if not flow or amount is None or not method or not transaction_currency(state):
         return False
     return True
 
 
-async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    user_id = update.message.from_user.id
-    user = get_user(user_id)
-    state = user.get("state", {})
+@router.message("deposit", 1)
+async def on_deposit_amount(update, context, user_id, state, user_input):
+    amount = money.parse_amount(user_input)
+    if amount is None:
+        await update.message.reply_text("Enter a valid positive number for deposit amount.")
+        return
 
-    if not state:
-        state = {}
+    state["amount"] = str(amount)
+    state["step"] = 2
+    state_store.put(user_id, state)
+    await show_payment_methods(update, context, user_id)
 
-    user_input = update.message.text
 
-    try:
-        if state.get("flow") == "deposit" and state.get("step") == 1:
-            if not user_input.isdigit() or int(user_input) <= 0:
-                await update.message.reply_text("Enter a valid positive integer for deposit amount.")
-                return
+@router.message("deposit", 4)
+async def on_deposit_crypto_address(update, context, user_id, state, user_input):
+    method_type = state.get("selected_method_type")
+    crypto_type = state.get("selected_crypto_type", "").upper()
 
-            amount = int(user_input)
-            state["amount"] = amount
-            state["step"] = 2
-            update_user(user_id, {"state": state})
-            await show_payment_methods(update, context, user_id)
-
-        elif state.get("flow") == "deposit" and state.get("step") == 4:
-            method_type = state.get("selected_method_type")
-            crypto_type = state.get("selected_crypto_type", "").upper()
-            amount = state.get("amount")
-
-            if method_type == 'crypto' and crypto_type:
-                add_unique_method(user_id, {
-                    "type": "crypto",
-                    "crypto_type": crypto_type,
-                    "details": user_input
-                })
-                state["step"] = 2
-                update_user(user_id, {"state": state})
-                await show_payment_methods(update, context, user_id)
-
-        elif state.get("flow") == "deposit" and state.get("step") == 3:
-            method_type = state.get("selected_method_type")
-
-            if method_type == 'bank_transfer':
-                add_unique_method(user_id, {"type": "bank_transfer", "details": user_input})
-                state["selected_method_details"] = user_input
-                state["step"] = 4
-                update_user(user_id, {"state": state})
-                await show_payment_methods(update, context, user_id)
-
-            elif method_type == 'paypal':
-                add_unique_method(user_id, {"type": "paypal", "details": user_input})
-                state["selected_method_details"] = user_input
-                state["step"] = 4
-                update_user(user_id, {"state": state})
-                await show_payment_methods(update, context, user_id)
-
-        elif state.get("flow") == "withdraw" and state.get("step") == 1:
-            if not user_input.isdigit() or int(user_input) <= 0:
-                await update.message.reply_text("Enter a valid positive integer for withdrawal amount.")
-                return
+    if method_type == 'crypto' and crypto_type:
+        await add_unique_method(user_id, "crypto", user_input, crypto_type)
+        state["step"] = 2
+        state_store.put(user_id, state)
+        await show_payment_methods(update, context, user_id)
 
-            amount = int(user_input)
 
-            total_balance = calculate_detailed_balance(user_id)["total_balance"]
-            if amount > total_balance:
-                await update.message.reply_text(
-                    "Withdrawal amount exceeds your total balance. Enter a valid amount."
-                )
-                return
+@router.message("deposit", 3)
+async def on_deposit_method_details(update, context, user_id, state, user_input):
+    method_type = state.get("selected_method_type")
 
-            state["amount"] = amount
-            state["step"] = 2
-            update_user(user_id, {"state": state})
-            await show_payment_methods(update, context, user_id)
-    except Exception as e:
-        await update.message.reply_text("An error occurred. Please try again later.")
+    if method_type in ['bank_transfer', 'paypal']:
+        await add_unique_method(user_id, method_type, user_input)
+        state["selected_method_details"] = user_input
+        state["step"] = 4
+        state_store.put(user_id, state)
+        await show_payment_methods(update, context, user_id)
 
 
-async def button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    query = update.callback_query
-    await query.answer()
-    user_id = query.from_user.id
-    user = get_user(user_id)
-    state = user.get("state", {})
+@router.message("withdraw", 1)
+async def on_withdraw_amount(update, context, user_id, state, user_input):
+    amount = money.parse_amount(user_input)
+    if amount is None:
+        await update.message.reply_text("Enter a valid positive number for withdrawal amount.")
+        return
 
-    if not state:
-        state = {}
+    # The currency is only known once a payment method is chosen, so reject
+    # amounts that no single holding could cover; the final check is atomic.
+    balance_details = await calculate_detailed_balance(user_id)
+    largest_holding = max([balance_details["fiat_balance"], *balance_details["crypto_balances"].values()])
+    if amount > largest_holding:
+        await update.message.reply_text(
+            "Withdrawal amount exceeds your balance. Enter a valid amount."
+        )
+        return
 
-    try:
-        if query.data == 'check_balance':
-            await show_user_balance(query, context, user_id)
-        elif query.data == 'deposit':
-            state["flow"] = "deposit"
-            state["step"] = 1
-            update_user(user_id, {"state": state})
-            await query.edit_message_text("Enter the amount to deposit:")
-        elif query.data == 'withdraw':
-            state["flow"] = "withdraw"
-            state["step"] = 1
-            update_user(user_id, {"state": state})
-            await query.edit_message_text("Enter the amount to withdraw:")
-        elif query.data == 'back_to_menu':
-            await show_main_menu(query, context)
-        elif query.data == 'add_payment_method':
-            state["step"] = 2
-            update_user(user_id, {"state": state})
-            await query.edit_message_text(
-                text="Choose a method type:",
-                reply_markup=InlineKeyboardMarkup(
-                    build_menu([
-                        InlineKeyboardButton("Bank Transfer", callback_data='bank_transfer'),
-                        InlineKeyboardButton("Paypal", callback_data='paypal'),
-                        InlineKeyboardButton("Crypto", callback_data='crypto'),
-                        InlineKeyboardButton('Cancel', callback_data='cancel')
-                    ], 1)
-                )
-            )
-        elif query.data == 'bank_transfer':
-            state["selected_method_type"] = query.data
-            state["step"] = 3
-            update_user(user_id, {"state": state})
-            await query.edit_message_text("Enter the name of the bank:")
-        elif query.data == 'paypal':
-            state["selected_method_type"] = query.data
-            state["step"] = 3
-            update_user(user_id, {"state": state})
-            await query.edit_message_text("Enter your Paypal e-mail address:")
-        elif query.data == 'crypto':
-            state["selected_method_type"] = query.data
-            state["step"] = 3
-            update_user(user_id, {"state": state})
-            await query.edit_message_text(
-                text="Choose a Crypto type:",
-                reply_markup=InlineKeyboardMarkup(
-                    build_menu([
-                        InlineKeyboardButton("BTC", callback_data='btc'),
-                        InlineKeyboardButton("ETH", callback_data='eth'),
-                        InlineKeyboardButton("USDT", callback_data='usdt'),
-                        InlineKeyboardButton('Cancel', callback_data='cancel')
-                    ], 1)
-                )
-            )
-        elif query.data in ['btc', 'eth', 'usdt']:
-            state["selected_crypto_type"] = query.data
-            state["step"] = 4
-            update_user(user_id, {"state": state})
-            await query.edit_message_text(text=f"Enter your {query.data.upper()} address:")
-        elif query.data == 'cancel':
-            update_user(user_id, {"$unset": {"state": ""}})
-            await query.edit_message_text("Operation cancelled. Thank you for using Deeper Systems. Goodbye!")
-            return
-        elif query.data == 'confirm_yes':
-            if not validate_transaction_data(state):
-                await query.edit_message_text("An error occurred: Flow, amount, or method is not defined.")
-                return
+    state["amount"] = str(amount)
+    state["step"] = 2
+    state_store.put(user_id, state)
+    await show_payment_methods(update, context, user_id)
 
-            flow = state.get("flow")
-            amount = state.get("amount")
-            method_type = state.get("selected_method_type")
-            selected_method_details = state.get("selected_method_details", "")
 
-            try:
-                meio = method_type
-                currency = "USD"
-                valor = amount
+@router.callback('check_balance')
+async def on_check_balance(query, context, user_id, state):
+    await show_user_balance(query, context, user_id)
 
-                if flow == "deposit":
-                    add_transaction(user_id, "deposit", meio, currency, valor)
-                    await query.edit_message_text(
-                        f"Deposited {amount} using {method_type}. Thank you for using Deeper Systems. Goodbye!")
-                elif flow == "withdraw":
-                    total_balance = calculate_detailed_balance(user_id)["total_balance"]
-                    if valor > total_balance:
-                        await query.edit_message_text(
-                            f"Withdraw amount exceeds your total balance. Enter a valid amount."
-                        )
-                        return
-
-                    if method_type in ['bank_transfer', 'paypal']:
-                        fiat_balance = calculate_detailed_balance(user_id)['fiat_balance']
-                        if valor > fiat_balance:
-                            await query.edit_message_text(
-                                f"Insufficient fiat balance for {method_type}. Withdrawal denied."
-                            )
-                            return
-
-                    elif method_type == 'crypto':
-                        crypto_type = state.get("selected_crypto_type", "").upper()
-                        crypto_balance = calculate_detailed_balance(user_id)['crypto_balances'].get(crypto_type, 0)
-                        if valor > crypto_balance:
-                            await query.edit_message_text(
-                                f"Insufficient {crypto_type} balance. Withdrawal denied."
-                            )
-                            return
-
-                    add_transaction(user_id, "withdraw", meio, currency, valor)
-                    await query.edit_message_text(
-                        f"Withdrawn {amount} using {method_type}. Thank you for using Deeper Systems. Goodbye!")
 
-                update_user(user_id, {"$unset": {"state": ""}})
-            except Exception as e:
-                await query.edit_message_text(
-                    "An error occurred while processing your transaction. Please try again later.")
-            return
+@router.callback('deposit', 'withdraw')
+async def on_start_flow(query, context, user_id, state):
+    state["flow"] = query.data
+    state["step"] = 1
+    state_store.put(user_id, state)
+    await query.edit_message_text(f"Enter the amount to {query.data}:")
+
+
+@router.callback('back_to_menu')
+async def on_back_to_menu(query, context, user_id, state):
+    await show_main_menu(query, context)
+
 
-        elif query.data == 'confirm_no':
-            update_user(user_id, {"$unset": {"state": ""}})
-            await query.edit_message_text("Operation cancelled. Thank you for using Deeper Systems. Goodbye!")
-            return
+@router.callback('history')
+async def on_history(query, context, user_id, state):
+    await show_history(query, context, user_id)
+
+
+@router.callback_prefix('history', r'history_(older|newer)_([0-9.]+)_([0-9a-f]{24})')
+async def on_history_page(query, context, user_id, state, direction, timestamp, transaction_id):
+    cursor = (float(timestamp), ObjectId(transaction_id))
+    await show_history(query, context, user_id, cursor, newer=direction == 'newer')
+
+
+@router.callback('add_payment_method', flows=FLOWS, steps={2, 4})
+async def on_add_payment_method(query, context, user_id, state):
+    state["step"] = 2
+    state_store.put(user_id, state)
+    await query.edit_message_text(text="Choose a method type:", reply_markup=keyboards.METHOD_TYPES)
+
+
+@router.callback('bank_transfer', 'paypal', flows=FLOWS, steps={2})
+async def on_select_method_type(query, context, user_id, state):
+    state["selected_method_type"] = query.data
+    state["step"] = 3
+    state_store.put(user_id, state)
+    if query.data == 'bank_transfer':
+        await query.edit_message_text("Enter the name of the bank:")
+    else:
+        await query.edit_message_text("Enter your Paypal e-mail address:")
+
+
+@router.callback('crypto', flows=FLOWS, steps={2})
+async def on_select_crypto(query, context, user_id, state):
+    state["selected_method_type"] = query.data
+    state["step"] = 3
+    state_store.put(user_id, state)
+    await query.edit_message_text(text="Choose a Crypto type:", reply_markup=keyboards.CRYPTO_TYPES)
+
+
+@router.callback('btc', 'eth', 'usdt', flows=FLOWS, steps={3})
+async def on_select_crypto_type(query, context, user_id, state):
+    state["selected_crypto_type"] = query.data
+    state["step"] = 4
+    state_store.put(user_id, state)
+    await query.edit_message_text(text=f"Enter your {query.data.upper()} address:")
+
+
+@router.callback('cancel', 'confirm_no')
+async def on_cancel(query, context, user_id, state):
+    state_store.clear(user_id)
+    await query.edit_message_text("Operation cancelled. Thank you for using Deeper Systems. Goodbye!")
+
+
+@router.callback_prefix('use_method', r'use_method_([0-9a-f]{12})', flows=FLOWS, steps={2, 4})
+async def on_use_method(query, context, user_id, state, method_id):
+    selected_method = await get_payment_method(user_id, method_id)
+    if selected_method:
+        state["selected_method_type"] = selected_method['type']
+        state["selected_method_details"] = selected_method['details']
+        if selected_method.get('crypto_type'):
+            state["selected_crypto_type"] = selected_method['crypto_type'].lower()
         else:
-            import re
-            match = re.match(r'use_method_(\w+)_(\d+)', query.data)
-            if match:
-                method_type = match.group(1)
-                method_index = int(match.group(2))
-                selected_method = user['deposit_methods'][method_index]
-                if selected_method:
-                    state["selected_method_type"] = selected_method['type']
-                    state["selected_method_details"] = selected_method['details']
-                    state["step"] = 4
-                    update_user(user_id, {"state": state})
+            state.pop("selected_crypto_type", None)
+        state["step"] = 4
+        state_store.put(user_id, state)
+        await query.edit_message_text(
+            text=f"Confirm {state['flow']} of {state['amount']} using {selected_method['type']} "
+                 f"({selected_method['details']})?\n\nPress 'Yes' to confirm or 'No' to cancel.",
+            reply_markup=keyboards.CONFIRM
+        )
+    else:
+        payment_method_keyboards.invalidate(user_id)
+        await show_payment_methods(query, context, user_id)
+
+
+@router.callback('confirm_yes')
+async def on_confirm(query, context, user_id, state):
+    if not validate_transaction_data(state):
+        await query.edit_message_text("An error occurred: Flow, amount, or method is not defined.")
+        return
+
+    flow = state.get("flow")
+    amount = Decimal(str(state.get("amount")))
+    method_type = state.get("selected_method_type")
+    currency = transaction_currency(state)
+
+    try:
+        meio = method_type
+        valor = amount
+
+        if flow == "deposit":
+            key = idempotency_key(query)
+            unit = UnitOfWork(user_id)
+            unit.add_transaction("deposit", meio, currency, valor, key)
+            unit.clear_state()
+            stored = await async_database.commit(unit)
+            # A deposit that was not credited is fine only if an earlier tap credited it.
+            if not stored[0] and not await async_database.is_processed(user_id, key):
+                await query.edit_message_text(
+                    "An error occurred while processing your transaction. Please try again later.")
+                return
+            if stored[0]:
+                state_store.forget(user_id)
+            else:
+                state_store.clear(user_id)
+            await query.edit_message_text(
+                f"Deposited {amount} {currency} using {method_type}. Thank you for using Deeper Systems. Goodbye!")
+        elif flow == "withdraw":
+            result = await withdraw(user_id, meio, currency, valor, idempotency_key(query), clear_state=True)
+            if result == WITHDRAW_INSUFFICIENT:
+                if method_type == 'crypto':
+                    await query.edit_message_text(f"Insufficient {currency} balance. Withdrawal denied.")
+                else:
                     await query.edit_message_text(
-                        text=f"Confirm {state['flow']} of {state['amount']} using {selected_method['type']} "
-                             f"({selected_method['details']})?\n\nPress 'Yes' to confirm or 'No' to cancel.",
-                        reply_markup=InlineKeyboardMarkup(build_menu([
-                            InlineKeyboardButton("Yes", callback_data='confirm_yes'),
-                            InlineKeyboardButton("No", callback_data='confirm_no')
-                        ], 2))
+                        f"Insufficient fiat balance for {method_type}. Withdrawal denied."
                     )
+                return
+
+            if result == WITHDRAW_OK:
+                state_store.forget(user_id)
             else:
-                await query.edit_message_text("Invalid selection. Please try again.")
+                state_store.clear(user_id)
+            await query.edit_message_text(
+                f"Withdrawn {amount} {currency} using {method_type}. Thank you for using Deeper Systems. Goodbye!")
+    except money.CurrencyError as e:
+        await query.edit_message_text(f"{e}. Please start again with a valid amount.")
     except Exception as e:
-        await query.edit_message_text(f"An error occurred: {e}")
+        record_handler_error("button:confirm_yes", e)
+        await query.edit_message_text(
+            "An error occurred while processing your transaction. Please try again later.")
+
+
+async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    user_id = update.message.from_user.id
+    state = await state_store.get(user_id)
+    route = router.resolve_message(state)
+    if route is None:
+        return
+
+    step = f"message:{route.name}"
+    with track_handler(step):
+        try:
+            await route.handler(update, context, user_id, state, update.message.text)
+        except Exception as e:
+            record_handler_error(step, e)
+            await update.message.reply_text("An error occurred. Please try again later.")
+
+
+async def button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    route, args = router.resolve_callback(query.data)
+    step = f"button:{route.name if route else 'unknown'}"
+
+    with track_handler(step):
+        await query.answer()
+        user_id = query.from_user.id
+        state = await state_store.get(user_id)
+
+        try:
+            if route is None:
+                await query.edit_message_text("Invalid selection. Please try again.")
+            elif not route.allows(state):
+                await query.edit_message_text("This option is no longer available. Use /start to begin again.")
+            else:
+                await route.handler(query, context, user_id, state, *args)
+        except Exception as e:
+            record_handler_error(step, e)
+            await query.edit_message_text(f"An error occurred: {e}")
 
 
 async def debug_restart(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Stopping the application lets in-flight handlers finish, acknowledges the
+    # fetched updates to Telegram and runs on_shutdown; main() then re-executes
+    # the process.
+    global restart_requested
+    restart_requested = True
     await update.message.reply_text("Restarting...")
-    os.execv(sys.executable, ['python'] + sys.argv)
-    sys.exit(0)
+    context.application.stop_running()
+
+
+async def on_startup(application: Application) -> None:
+    global metrics_server
+    await cluster_member.start(application)
+    state_store.start()
+    cache_invalidator.start()
+    metrics_server = await metrics.start_server()
+
+    startup_seconds = time.time() - start_time - standby_seconds
+    metrics.startup_duration.observe("total", startup_seconds)
+    if startup_seconds > STARTUP_BUDGET:
+        print(f"Startup took {startup_seconds:.2f}s, over the {STARTUP_BUDGET:.2f}s budget.")
+
+
+async def on_shutdown(application: Application) -> None:
+    if metrics_server is not None:
+        metrics_server.close()
+    await cache_invalidator.stop()
+    await state_store.close()
+    await cluster_member.stop()
+    async_database.shutdown()
+    close_client()
 
 
 def main() -> None:
-    application = Application.builder().token(TELEGRAM_TOKEN).build()
+    global standby_seconds
+    if not TELEGRAM_TOKEN:
+        raise ValueError(
+            "Telegram token not found. Please ensure the TELEGRAM_TOKEN environment variable is correctly set."
+        )
+    if BOT_MODE == 'webhook' and not WEBHOOK_URL:
+        raise ValueError(
+            "Webhook URL not found. Please set the WEBHOOK_URL environment variable when BOT_MODE is 'webhook'."
+        )
+    if BOT_MODE == 'webhook' and not WEBHOOK_INTERNAL_URL:
+        # Without it the shard leases carry no address and every replica would
+        # handle whatever it receives, breaking per-user ordering.
+        raise ValueError(
+            "Webhook internal URL not found. Please set the WEBHOOK_INTERNAL_URL environment variable when "
+            "BOT_MODE is 'webhook'."
+        )
+
+    with track_startup("mongo_warm_up"):
+        warm_up()
+    with track_startup("indexes"):
+        ensure_indexes()
+        if MONGO_INDEX_SELF_CHECK:
+            verify_index_usage()
+    with track_startup("application"):
+        application = (
+            Application.builder()
+            .token(TELEGRAM_TOKEN)
+            .concurrent_updates(PerUserUpdateProcessor())
+            .rate_limiter(FloodLimiter())
+            .post_init(on_startup)
+            .post_shutdown(on_shutdown)
+            .build()
+        )
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("debug_uptime", debug_uptime))
     application.add_handler(CommandHandler("debug_restart", debug_restart))
+    application.add_handler(CommandHandler("debug_stats", debug_stats))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
     application.add_handler(CallbackQueryHandler(button))
 
-    application.run_polling()
+    if BOT_MODE == 'webhook':
+        application.add_handler(TypeHandler(Update, cluster_member.route_update), group=-1)
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET
+        )
+    else:
+        standby_started = time.time()
+        wait_for_poller_lease()
+        standby_seconds = time.time() - standby_started
+        application.run_polling()
+
+    if restart_requested:
+        os.execv(sys.executable, [sys.executable] + sys.argv)
 
 
 if __name__ == '__main__':
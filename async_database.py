@@ -0,0 +1,53 @@
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial, wraps
+
+import database
+
+DB_EXECUTOR_WORKERS = int(os.getenv("DB_EXECUTOR_WORKERS", "16"))
+DB_CALL_TIMEOUT = float(os.getenv("DB_CALL_TIMEOUT", "10"))
+
+# pymongo is blocking, so every call runs on a bounded pool of worker threads
+# instead of the python-telegram-bot event loop. Keep DB_EXECUTOR_WORKERS at or
+# below MONGO_MAX_POOL_SIZE so threads never queue on the connection pool.
+_executor = ThreadPoolExecutor(max_workers=DB_EXECUTOR_WORKERS, thread_name_prefix="mongo")
+
+
+async def run_db(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await asyncio.wait_for(
+        loop.run_in_executor(_executor, partial(func, *args, **kwargs)),
+        timeout=DB_CALL_TIMEOUT
+    )
+
+
+def _offload(func):
+    @wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await run_db(func, *args, **kwargs)
+
+    return wrapper
+
+
+def shutdown():
+    _executor.shutdown(wait=True)
+
+
+get_user = _offload(database.get_user)
+get_user_state = _offload(database.get_user_state)
+create_user_if_not_exists = _offload(database.create_user_if_not_exists)
+update_user = _offload(database.update_user)
+add_payment_method = _offload(database.add_payment_method)
+get_payment_methods = _offload(database.get_payment_methods)
+get_payment_method = _offload(database.get_payment_method)
+get_transactions = _offload(database.get_transactions)
+get_transaction_page = _offload(database.get_transaction_page)
+add_transaction = _offload(database.add_transaction)
+commit = _offload(database.commit)
+is_processed = _offload(database.is_processed)
+get_balances = _offload(database.get_balances)
+withdraw = _offload(database.withdraw)
+acquire_lease = _offload(database.acquire_lease)
+release_lease = _offload(database.release_lease)
+get_active_leases = _offload(database.get_active_leases)
@@ -0,0 +1,233 @@
+import argparse
+import asyncio
+import itertools
+import os
+import statistics
+import sys
+import time
+from collections import defaultdict
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("TELEGRAM_TOKEN", "123456:benchmark")
+os.environ.setdefault("MONGO_INDEX_SELF_CHECK", "0")
+
+from telegram import CallbackQuery, Chat, Message, Update, User  # noqa: E402
+
+import database  # noqa: E402
+
+DB_METHODS = {
+    "find", "find_one", "insert_one", "insert_many", "update_one", "update_many", "delete_one", "delete_many",
+    "find_one_and_update", "count_documents", "aggregate", "bulk_write", "create_index", "distinct",
+}
+
+DEPOSIT_FLOW = [
+    ("command", "/start"),
+    ("tap", "deposit"),
+    ("type", "100"),
+    ("tap", "add_payment_method"),
+    ("tap", "paypal"),
+    ("type", "{user_id}@example.com"),
+    ("tap", "use_method_"),
+    ("tap", "confirm_yes"),
+]
+
+WITHDRAW_FLOW = [
+    ("tap", "withdraw"),
+    ("type", "40"),
+    ("tap", "use_method_"),
+    ("tap", "confirm_yes"),
+    ("tap", "check_balance"),
+]
+
+
+class CountingCollection:
+    def __init__(self, collection, counter):
+        self._collection = collection
+        self._counter = counter
+
+    def __getattr__(self, name):
+        attribute = getattr(self._collection, name)
+        if name not in DB_METHODS:
+            return attribute
+
+        def counted(*args, **kwargs):
+            self._counter[name] += 1
+            return attribute(*args, **kwargs)
+
+        return counted
+
+
+def bind_database(client, counter):
+    database.client = client
+    database.db = client[database.MONGO_DB_NAME]
+    for attribute in list(vars(database)):
+        if attribute.endswith("_collection"):
+            name = getattr(database, attribute).name
+            setattr(database, attribute, CountingCollection(database.db[name], counter))
+
+
+class StubBot:
+    """Stands in for telegram.Bot: records what would be sent instead of calling the API."""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.message_ids = itertools.count(1)
+        self.last_message = {}
+
+    async def _respond(self, chat_id, text, reply_markup, message_id=None):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        message_id = message_id or next(self.message_ids)
+        self.last_message[chat_id] = (message_id, text, reply_markup)
+        return True
+
+    async def send_message(self, chat_id, text, reply_markup=None, **kwargs):
+        return await self._respond(chat_id, text, reply_markup)
+
+    async def edit_message_text(self, text, chat_id=None, message_id=None, reply_markup=None, **kwargs):
+        return await self._respond(chat_id, text, reply_markup, message_id)
+
+    async def answer_callback_query(self, callback_query_id, **kwargs):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return True
+
+
+class SimulatedUser:
+    update_ids = itertools.count(1)
+
+    def __init__(self, user_id, bot):
+        self.user_id = user_id
+        self.bot = bot
+        self.user = User(user_id, f"user{user_id}", False)
+        self.chat = Chat(user_id, Chat.PRIVATE)
+
+    def _message(self, message_id, text=None):
+        message = Message(message_id, None, self.chat, from_user=self.user, text=text)
+        message.set_bot(self.bot)
+        return message
+
+    def text_update(self, text):
+        update = Update(next(self.update_ids), message=self._message(next(self.bot.message_ids), text))
+        update.set_bot(self.bot)
+        return update
+
+    def callback_update(self, prefix):
+        message_id, _, reply_markup = self.bot.last_message[self.user_id]
+        data = prefix
+        if reply_markup is not None:
+            for row in reply_markup.inline_keyboard:
+                for button in row:
+                    if button.callback_data and button.callback_data.startswith(prefix):
+                        data = button.callback_data
+                        break
+                else:
+                    continue
+                break
+        query = CallbackQuery(str(next(self.update_ids)), self.user, str(self.user_id),
+                              message=self._message(message_id), data=data)
+        query.set_bot(self.bot)
+        update = Update(next(self.update_ids), callback_query=query)
+        update.set_bot(self.bot)
+        return update
+
+
+async def run_flow(app, user, flow, context, latencies):
+    for kind, value in flow:
+        if kind == "command":
+            handler, name, update = app.start, "start", user.text_update(value)
+        elif kind == "type":
+            handler, name, update = app.handle_message, "handle_message", user.text_update(
+                value.format(user_id=user.user_id))
+        else:
+            handler, name, update = app.button, "button", user.callback_update(value)
+
+        started = time.perf_counter()
+        await handler(update, context)
+        elapsed = time.perf_counter() - started
+        latencies[name].append(elapsed)
+        latencies[f"{name}:{value.split('{')[0] if kind != 'type' else 'text'}"].append(elapsed)
+
+
+async def run_phase(app, users, flow, context, concurrency, counter):
+    latencies = defaultdict(list)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(user):
+        async with semaphore:
+            await run_flow(app, user, flow, context, latencies)
+
+    before = sum(counter.values())
+    started = time.perf_counter()
+    await asyncio.gather(*(one(user) for user in users))
+    await app.state_store.flush()
+    elapsed = time.perf_counter() - started
+    round_trips = sum(counter.values()) - before
+    return latencies, elapsed, round_trips
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def report(title, latencies, elapsed, round_trips, flows):
+    updates = len(latencies.get("start", [])) + len(latencies.get("button", [])) + len(
+        latencies.get("handle_message", []))
+    print(f"\n== {title}: {flows} flows, {updates} updates in {elapsed:.2f}s "
+          f"({updates / elapsed:.0f} updates/s, {round_trips / flows:.1f} DB round-trips per flow)")
+    print(f"{'handler':<32}{'calls':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'mean ms':>10}")
+    for name in sorted(latencies):
+        values = latencies[name]
+        print(f"{name:<32}{len(values):>8}{percentile(values, 0.5) * 1000:>10.2f}"
+              f"{percentile(values, 0.95) * 1000:>10.2f}{percentile(values, 0.99) * 1000:>10.2f}"
+              f"{statistics.fmean(values) * 1000:>10.2f}")
+
+
+async def main_async(args):
+    counter = defaultdict(int)
+    if args.mongo_uri:
+        client = database.init_client(args.mongo_uri)
+        client.drop_database(database.MONGO_DB_NAME)
+    else:
+        try:
+            import mongomock
+        except ImportError:
+            raise SystemExit("mongomock is required without --mongo-uri: pip install -r requirements-bench.txt")
+        client = mongomock.MongoClient()
+    bind_database(client, counter)
+
+    import app
+    if args.mongo_uri:
+        database.ensure_indexes()
+
+    bot = StubBot(latency=args.bot_latency / 1000)
+    context = SimpleNamespace(bot=bot)
+    users = [SimulatedUser(user_id, bot) for user_id in range(1, args.users + 1)]
+
+    app.state_store.start()
+    try:
+        for title, flow in (("deposit", DEPOSIT_FLOW), ("withdraw", WITHDRAW_FLOW)):
+            latencies, elapsed, round_trips = await run_phase(app, users, flow, context, args.concurrency, counter)
+            report(title, latencies, elapsed, round_trips, len(users))
+    finally:
+        await app.state_store.close()
+
+    print("\nDB calls by operation:")
+    for name, count in sorted(counter.items(), key=lambda item: -item[1]):
+        print(f"  {name:<24}{count:>10}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Drive the bot handlers through full deposit/withdraw flows.")
+    parser.add_argument("--users", type=int, default=1000, help="Number of simulated users.")
+    parser.add_argument("--concurrency", type=int, default=100, help="Users running their flow at the same time.")
+    parser.add_argument("--bot-latency", type=float, default=0.0, help="Simulated Telegram API latency in ms.")
+    parser.add_argument("--mongo-uri", help="Use a real (throwaway!) MongoDB instead of mongomock.")
+    args = parser.parse_args()
+    asyncio.run(main_async(args))
+
+
+if __name__ == '__main__':
+    main()
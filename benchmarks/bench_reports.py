@@ -0,0 +1,101 @@
+import argparse
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# Reports run in spawned worker processes that read their settings from the
+# environment, so point everything at a separate benchmark database first.
+os.environ["MONGO_DB_NAME"] = "bot_reports_benchmark"
+
+from bson.decimal128 import Decimal128  # noqa: E402
+
+import database  # noqa: E402
+import money  # noqa: E402
+import reports  # noqa: E402
+
+METHODS = [("bank_transfer", "USD"), ("paypal", "USD"), ("crypto", "BTC"), ("crypto", "ETH"), ("crypto", "USDT")]
+INSERT_BATCH_SIZE = 50000
+
+
+def generate_transactions(rows, users, days, seed):
+    rng = random.Random(seed)
+    end = time.time()
+    start = end - days * reports.DAY
+    for _ in range(rows):
+        method, currency = rng.choice(METHODS)
+        amount_minor = rng.randint(1, 10 ** (money.exponent(currency) + 3))
+        yield {
+            "user_id": rng.randint(1, users),
+            "transaction_type": "deposit" if rng.random() < 0.7 else "withdraw",
+            "method": method,
+            "currency": currency,
+            "amount": Decimal128(str(money.from_minor(currency, amount_minor))),
+            "amount_minor": amount_minor,
+            "timestamp": rng.uniform(start, end)
+        }
+
+
+def load(args):
+    database.get_db().drop_collection(database.transactions_collection.name)
+    database.ensure_indexes()
+    started = time.perf_counter()
+    batch = []
+    for done, transaction in enumerate(generate_transactions(args.rows, args.users, args.days, args.seed), 1):
+        batch.append(transaction)
+        if len(batch) == INSERT_BATCH_SIZE:
+            database.transactions_collection.insert_many(batch, ordered=False)
+            batch = []
+            print(f"\r{done}/{args.rows} transactions inserted", end="", flush=True)
+    if batch:
+        database.transactions_collection.insert_many(batch, ordered=False)
+    print(f"\nGenerated {args.rows} transactions in {time.perf_counter() - started:.1f}s.")
+
+
+def peak_rss_mb(who):
+    # ru_maxrss is in KiB on Linux.
+    return resource.getrusage(who).ru_maxrss / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time the ledger reports on a generated dataset.")
+    parser.add_argument("--mongo-uri", required=True, help="Throwaway MongoDB to load the dataset into.")
+    parser.add_argument("--rows", type=int, default=5_000_000, help="Transactions to generate.")
+    parser.add_argument("--users", type=int, default=200_000)
+    parser.add_argument("--days", type=int, default=365)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--skip-load", action="store_true", help="Reuse the dataset of a previous run.")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--format", choices=sorted(reports.WRITERS), default="csv")
+    parser.add_argument("--batch-size", type=int, default=reports.REPORT_BATCH_SIZE)
+    args = parser.parse_args()
+
+    os.environ["MONGO_URI"] = args.mongo_uri
+    database.init_client(args.mongo_uri)
+    if not args.skip_load:
+        load(args)
+    total = database.transactions_collection.estimated_document_count()
+
+    print(f"\n{'report':<18}{'workers':>8}{'rows':>10}{'seconds':>10}{'ledger rows/s':>16}{'worker RSS MB':>15}")
+    with tempfile.TemporaryDirectory() as output_dir:
+        for report in sorted(reports.ROWS):
+            for workers in args.workers:
+                report_args = SimpleNamespace(
+                    report=report, output=os.path.join(output_dir, f"{report}-{workers}.{args.format}"),
+                    format=args.format, start=None, end=None, workers=workers, batch_size=args.batch_size,
+                    limit=100, mismatches_only=False
+                )
+                started = time.perf_counter()
+                count = reports.run_report(report_args)
+                seconds = time.perf_counter() - started
+                print(f"{report:<18}{workers:>8}{count:>10}{seconds:>10.2f}{total / seconds:>16.0f}"
+                      f"{peak_rss_mb(resource.RUSAGE_CHILDREN):>15.0f}")
+    print(f"\nParent peak RSS: {peak_rss_mb(resource.RUSAGE_SELF):.0f} MB")
+
+
+if __name__ == '__main__':
+    main()
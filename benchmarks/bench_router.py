@@ -0,0 +1,41 @@
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("TELEGRAM_TOKEN", "123456:benchmark")
+
+import app  # noqa: E402
+
+CALLBACK_SAMPLES = [
+    "check_balance", "deposit", "withdraw", "add_payment_method", "paypal", "btc", "confirm_yes", "cancel",
+    "use_method_3f786850e387", "history_older_1760000000.123456_6710a0b1c2d3e4f5a6b7c8d9", "unknown_callback",
+]
+STATE_SAMPLES = [
+    {"flow": "deposit", "step": 1}, {"flow": "deposit", "step": 3}, {"flow": "withdraw", "step": 1}, {},
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the cost of resolving updates in the callback router.")
+    parser.add_argument("--number", type=int, default=200000)
+    args = parser.parse_args()
+
+    print(f"{'route':<24}{'flows':<22}{'steps':<10}")
+    for route in app.router.routes():
+        flows = ",".join(sorted(route.flows)) if route.flows else "any"
+        steps = ",".join(str(step) for step in sorted(route.steps)) if route.steps else "any"
+        print(f"{route.name:<24}{flows:<22}{steps:<10}")
+
+    print()
+    for data in CALLBACK_SAMPLES:
+        seconds = timeit.timeit(lambda: app.router.resolve_callback(data), number=args.number)
+        print(f"resolve_callback({data[:30]!r}): {seconds / args.number * 1e9:.0f} ns")
+    for state in STATE_SAMPLES:
+        seconds = timeit.timeit(lambda: app.router.resolve_message(state), number=args.number)
+        print(f"resolve_message({state}): {seconds / args.number * 1e9:.0f} ns")
+
+
+if __name__ == '__main__':
+    main()
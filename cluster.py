@@ -0,0 +1,170 @@
+import asyncio
+import math
+import os
+import time
+
+import httpx
+from telegram import Update
+from telegram.ext import ApplicationHandlerStop, ContextTypes
+
+import async_database
+import database
+
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", "16"))
+LEASE_TTL = float(os.getenv("LEASE_TTL", "15"))
+LEASE_RENEW_INTERVAL = float(os.getenv("LEASE_RENEW_INTERVAL", "5"))
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBHOOK_INTERNAL_URL = os.getenv("WEBHOOK_INTERNAL_URL")
+FORWARD_TIMEOUT = float(os.getenv("FORWARD_TIMEOUT", "5"))
+
+INSTANCE_ID = database.INSTANCE_ID
+POLLER_LEASE = "poller"
+MEMBER_LEASE_PREFIX = "member:"
+SHARD_LEASE_PREFIX = "shard:"
+
+
+def wait_for_poller_lease():
+    # Only one process may call getUpdates at a time, so polling replicas
+    # queue up here until the current holder stops renewing its lease.
+    announced = False
+    while not database.acquire_lease(POLLER_LEASE, INSTANCE_ID, LEASE_TTL):
+        if not announced:
+            print("Another instance is polling. Waiting for its lease to expire...")
+            announced = True
+        time.sleep(LEASE_RENEW_INTERVAL)
+
+
+class PollerLease:
+    def __init__(self):
+        self._task = None
+
+    async def _renew_loop(self, application):
+        held_until = time.monotonic() + LEASE_TTL
+        while True:
+            await asyncio.sleep(LEASE_RENEW_INTERVAL)
+            renewed_at = time.monotonic()
+            try:
+                renewed = await async_database.acquire_lease(POLLER_LEASE, INSTANCE_ID, LEASE_TTL)
+            except asyncio.TimeoutError:
+                renewed = None
+
+            if renewed:
+                held_until = renewed_at + LEASE_TTL
+            elif renewed is False:
+                print("Lost the polling lease. Stopping.")
+                application.stop_running()
+                return
+            elif time.monotonic() >= held_until:
+                # MongoDB could not be reached for a whole TTL, so another
+                # instance may have taken the lease over by now.
+                print("Could not renew the polling lease before it expired. Stopping.")
+                application.stop_running()
+                return
+
+    async def start(self, application):
+        self._task = asyncio.create_task(self._renew_loop(application))
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await async_database.release_lease(POLLER_LEASE, INSTANCE_ID)
+
+
+class ShardCoordinator:
+    """Splits users into SHARD_COUNT shards and spreads them across live replicas.
+
+    Each replica keeps a member lease plus one lease per shard it owns. Updates
+    that arrive at a replica which does not own the user's shard are forwarded
+    to the owner, so all updates of one user are handled by the same process.
+    """
+
+    def __init__(self, shard_count=SHARD_COUNT, address=WEBHOOK_INTERNAL_URL):
+        self.shard_count = shard_count
+        self.address = address
+        self.owned = set()
+        self.routes = {}
+        self._task = None
+        self._http = None
+
+    def shard_of(self, user_id):
+        return user_id % self.shard_count
+
+    async def rebalance(self):
+        await async_database.acquire_lease(MEMBER_LEASE_PREFIX + INSTANCE_ID, INSTANCE_ID, LEASE_TTL, self.address)
+        members = await async_database.get_active_leases(MEMBER_LEASE_PREFIX)
+        target = math.ceil(self.shard_count / max(len(members), 1))
+
+        for shard in sorted(self.owned):
+            renewed = await async_database.acquire_lease(f"{SHARD_LEASE_PREFIX}{shard}", INSTANCE_ID, LEASE_TTL,
+                                                         self.address)
+            if renewed is False:
+                self.owned.discard(shard)
+        while len(self.owned) > target:
+            shard = max(self.owned)
+            self.owned.discard(shard)
+            await async_database.release_lease(f"{SHARD_LEASE_PREFIX}{shard}", INSTANCE_ID)
+
+        leases = await async_database.get_active_leases(SHARD_LEASE_PREFIX)
+        taken = {int(lease["_id"][len(SHARD_LEASE_PREFIX):]) for lease in leases}
+        for shard in range(self.shard_count):
+            if len(self.owned) >= target:
+                break
+            if shard not in taken and await async_database.acquire_lease(
+                    f"{SHARD_LEASE_PREFIX}{shard}", INSTANCE_ID, LEASE_TTL, self.address):
+                self.owned.add(shard)
+
+        leases = await async_database.get_active_leases(SHARD_LEASE_PREFIX)
+        self.routes = {int(lease["_id"][len(SHARD_LEASE_PREFIX):]): lease.get("address") for lease in leases}
+
+    async def _rebalance_loop(self):
+        while True:
+            try:
+                await self.rebalance()
+            except Exception as e:
+                print(f"Error rebalancing shards: {e}")
+            await asyncio.sleep(LEASE_RENEW_INTERVAL)
+
+    async def route_update(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        user = update.effective_user
+        if user is None:
+            return
+        shard = self.shard_of(user.id)
+        address = self.routes.get(shard)
+        if shard in self.owned or not address or address == self.address:
+            return
+
+        try:
+            response = await self._http.post(
+                address,
+                content=update.to_json(),
+                headers={"Content-Type": "application/json", "X-Telegram-Bot-Api-Secret-Token": WEBHOOK_SECRET or ""}
+            )
+            response.raise_for_status()
+        except httpx.HTTPError as e:
+            # Handling the update out of shard is better than dropping it.
+            print(f"Error forwarding update {update.update_id} to shard {shard} at {address}: {e}")
+            return
+        raise ApplicationHandlerStop
+
+    async def start(self, application):
+        self._http = httpx.AsyncClient(timeout=FORWARD_TIMEOUT)
+        await self.rebalance()
+        self._task = asyncio.create_task(self._rebalance_loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        for shard in list(self.owned):
+            await async_database.release_lease(f"{SHARD_LEASE_PREFIX}{shard}", INSTANCE_ID)
+        self.owned.clear()
+        await async_database.release_lease(MEMBER_LEASE_PREFIX + INSTANCE_ID, INSTANCE_ID)
+        if self._http is not None:
+            await self._http.aclose()
+            self._http = None
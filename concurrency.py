@@ -0,0 +1,182 @@
+import asyncio
+import os
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+
+from telegram import Update
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter, BaseUpdateProcessor
+
+MAX_CONCURRENT_UPDATES = int(os.getenv("MAX_CONCURRENT_UPDATES", "256"))
+USER_RATE = float(os.getenv("USER_RATE", "3"))
+USER_BURST = int(os.getenv("USER_BURST", "10"))
+USER_BUCKETS_SIZE = int(os.getenv("USER_BUCKETS_SIZE", "100000"))
+OUTBOUND_RATE = float(os.getenv("OUTBOUND_RATE", "30"))
+OUTBOUND_CHAT_RATE = float(os.getenv("OUTBOUND_CHAT_RATE", "1"))
+OUTBOUND_CHAT_BURST = int(os.getenv("OUTBOUND_CHAT_BURST", "3"))
+OUTBOUND_GROUP_RATE = float(os.getenv("OUTBOUND_GROUP_RATE", str(20 / 60)))
+OUTBOUND_MAX_RETRIES = int(os.getenv("OUTBOUND_MAX_RETRIES", "2"))
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated_at = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def try_acquire(self):
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    async def acquire(self):
+        # Take the token now (possibly going negative) and sleep until it is
+        # covered, so concurrent waiters queue up instead of all waking at once.
+        self._refill()
+        self.tokens -= 1
+        if self.tokens < 0:
+            await asyncio.sleep(-self.tokens / self.rate)
+
+
+class BucketMap:
+    def __init__(self, rate, capacity, max_size=USER_BUCKETS_SIZE):
+        self.rate = rate
+        self.capacity = capacity
+        self.max_size = max_size
+        self._buckets = OrderedDict()
+
+    def get(self, key):
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(self.rate, self.capacity)
+            while len(self._buckets) > self.max_size:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+        return bucket
+
+
+class UserLocks:
+    def __init__(self):
+        self._locks = {}
+
+    @asynccontextmanager
+    async def hold(self, user_id):
+        entry = self._locks.get(user_id)
+        if entry is None:
+            entry = self._locks[user_id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[user_id]
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Runs updates of different users concurrently and updates of one user in order.
+
+    Each user also gets a token bucket; updates beyond it are dropped, and the
+    user is told once per burst (callback queries are answered, so the client
+    also stops its spinner). The per-user lock is taken inside the global slot,
+    as `process_update` is final; the bucket keeps one user from holding more
+    than `user_burst` of those slots while their updates wait for each other.
+    """
+
+    def __init__(self, max_concurrent_updates=MAX_CONCURRENT_UPDATES, user_rate=USER_RATE, user_burst=USER_BURST):
+        super().__init__(max_concurrent_updates)
+        self.user_locks = UserLocks()
+        self.user_buckets = BucketMap(user_rate, user_burst)
+        self._warned = set()
+
+    async def do_process_update(self, update, coroutine):
+        user = update.effective_user if isinstance(update, Update) else None
+        if user is None:
+            await coroutine
+            return
+
+        if not self.user_buckets.get(user.id).try_acquire():
+            coroutine.close()
+            await self._reject(update, user.id)
+            return
+
+        self._warned.discard(user.id)
+        async with self.user_locks.hold(user.id):
+            await coroutine
+
+    async def _reject(self, update, user_id):
+        if update.callback_query:
+            await update.callback_query.answer("Too many requests. Please slow down.")
+        elif update.message and user_id not in self._warned:
+            # Only the first dropped message of a burst gets a reply, so a
+            # flooding user does not turn into a flood of replies.
+            self._warned.add(user_id)
+            await update.message.reply_text("Too many requests. Please slow down.")
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+
+class FloodLimiter(BaseRateLimiter):
+    """Keeps outgoing Bot API calls under Telegram's flood limits.
+
+    Requests share a global bucket (OUTBOUND_RATE per second). Requests for a
+    chat also take from that chat's bucket: groups are limited to about 20 per
+    minute and private chats to OUTBOUND_CHAT_RATE per second with a small
+    burst. If Telegram still answers with RetryAfter, every request waits for
+    the requested time before the call is retried.
+    """
+
+    def __init__(self, overall_rate=OUTBOUND_RATE, chat_rate=OUTBOUND_CHAT_RATE, chat_burst=OUTBOUND_CHAT_BURST,
+                 group_rate=OUTBOUND_GROUP_RATE, max_retries=OUTBOUND_MAX_RETRIES):
+        self.overall = TokenBucket(overall_rate, overall_rate)
+        self.chats = BucketMap(chat_rate, chat_burst)
+        self.groups = BucketMap(group_rate, 1)
+        self.max_retries = max_retries
+        self._resume = asyncio.Event()
+        self._resume.set()
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        max_retries = rate_limit_args if rate_limit_args is not None else self.max_retries
+        chat_id = data.get("chat_id")
+        try:
+            chat_id = int(chat_id)
+        except (TypeError, ValueError):
+            pass
+
+        for attempt in range(max_retries + 1):
+            await self._resume.wait()
+            if isinstance(chat_id, int) and chat_id > 0:
+                await self.chats.get(chat_id).acquire()
+            elif chat_id is not None:
+                await self.groups.get(chat_id).acquire()
+            await self.overall.acquire()
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                if attempt == max_retries:
+                    raise
+                delay = e.retry_after.total_seconds() if hasattr(e.retry_after, "total_seconds") else e.retry_after
+                self._resume.clear()
+                await asyncio.sleep(delay + 0.1)
+                self._resume.set()
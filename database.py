@@ -1,38 +1,185 @@
-from pymongo import MongoClient, errors
+from pymongo import ASCENDING, DESCENDING, MongoClient, ReturnDocument, UpdateOne, errors
+import gzip
+import hashlib
+import itertools
 import os
+import re
+import socket
+import threading
 import time
+import uuid
+from collections import defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, timezone
+
+import bson
+from bson import json_util
+from bson.decimal128 import Decimal128
+
+import metrics
+import money
 
 MONGO_URI = os.getenv("MONGO_URI", "mongodb://localhost:27016/bot_database")
-client = MongoClient(MONGO_URI)
-db = client['bot_database']
-users_collection = db['users']
-transactions_collection = db['transactions']
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", "50"))
+MONGO_MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", "0"))
+MONGO_CONNECT_TIMEOUT_MS = int(os.getenv("MONGO_CONNECT_TIMEOUT_MS", "5000"))
+MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.getenv("MONGO_SERVER_SELECTION_TIMEOUT_MS", "5000"))
+# No socket timeout by default: manage.py and the report workers run single
+# aggregations that send nothing back until they finish. Bot handlers are
+# bounded by async_database.DB_CALL_TIMEOUT instead.
+MONGO_SOCKET_TIMEOUT_MS = int(os.getenv("MONGO_SOCKET_TIMEOUT_MS", "0")) or None
 
+# Identifies this process in leases and in the `writer` field of user documents.
+INSTANCE_ID = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+MONGO_DB_NAME = os.getenv("MONGO_DB_NAME", "bot_database")
+MONGO_WARM_UP_CONNECTIONS = int(os.getenv("MONGO_WARM_UP_CONNECTIONS", "4"))
+
+# The client is created on first use instead of at import, so importing this
+# module (from the bot, manage.py or the benchmarks) never touches the network.
+client = None
+db = None
+_client_lock = threading.Lock()
+
+
+def init_client(uri=MONGO_URI):
+    global client, db
+    with _client_lock:
+        if client is None:
+            client = MongoClient(
+                uri,
+                maxPoolSize=MONGO_MAX_POOL_SIZE,
+                minPoolSize=MONGO_MIN_POOL_SIZE,
+                connectTimeoutMS=MONGO_CONNECT_TIMEOUT_MS,
+                serverSelectionTimeoutMS=MONGO_SERVER_SELECTION_TIMEOUT_MS,
+                socketTimeoutMS=MONGO_SOCKET_TIMEOUT_MS,
+                event_listeners=[metrics.CommandMetrics()],
+            )
+            db = client[MONGO_DB_NAME]
+    return client
+
+
+def get_db():
+    if db is None:
+        init_client()
+    return db
+
+
+def close_client():
+    global client, db
+    with _client_lock:
+        if client is not None:
+            client.close()
+        client = None
+        db = None
+
+
+class _LazyCollection:
+    def __init__(self, name):
+        self.name = name
+
+    def __getattr__(self, attribute):
+        return getattr(get_db()[self.name], attribute)
+
+
+users_collection = _LazyCollection('users')
+transactions_collection = _LazyCollection('transactions')
+leases_collection = _LazyCollection('leases')
+meta_collection = _LazyCollection('meta')
+snapshots_collection = _LazyCollection('balance_snapshots')
+
+
+def warm_up(connections=MONGO_WARM_UP_CONNECTIONS):
+    """Selects a server and opens `connections` pooled connections before the first update arrives."""
+    init_client()
+    get_db().command("ping")
+    if connections > 1:
+        with ThreadPoolExecutor(max_workers=connections) as executor:
+            list(executor.map(lambda _: get_db().command("ping"), range(connections)))
+
+FIAT_METHODS = ["bank_transfer", "paypal"]
+USER_CHANGE_FIELDS = {"_id": 0, "user_id": 1, "updated_at": 1}
+_write_sequence = itertools.count()
+
+WITHDRAW_OK = "ok"
+WITHDRAW_DUPLICATE = "duplicate"
+WITHDRAW_INSUFFICIENT = "insufficient_funds"
+PROCESSED_KEYS_LIMIT = int(os.getenv("PROCESSED_KEYS_LIMIT", "50"))
+LEDGER_WRITE_RETRIES = 3
+DUPLICATE_KEY_ERROR = 11000
+RECOMPUTE_BATCH_SIZE = int(os.getenv("RECOMPUTE_BATCH_SIZE", "1000"))
+BALANCES_WATERMARK = "balances_watermark"
+BALANCES_WATERMARK_OVERLAP = 60
+LEDGER_CHECKPOINT = "ledger_checkpoint"
+LEDGER_RETENTION_DAYS = int(os.getenv("LEDGER_RETENTION_DAYS", "90"))
+# A checkpoint must be this many seconds in the past, so that no transaction
+# still being written (or stamped by a host with a fast clock) is older than it.
+LEDGER_CHECKPOINT_MARGIN = 86400
+ARCHIVE_COLLECTION_PREFIX = "transactions_archive_"
+GROUP_COMMIT = os.getenv("GROUP_COMMIT", "1") == "1"
+GROUP_COMMIT_WINDOW = float(os.getenv("GROUP_COMMIT_WINDOW_MS", "2")) / 1000
+# At most DB_EXECUTOR_WORKERS threads commit at once, so larger batches never fill up.
+GROUP_COMMIT_MAX_BATCH = int(os.getenv("GROUP_COMMIT_MAX_BATCH", os.getenv("DB_EXECUTOR_WORKERS", "16")))
+PAYMENT_METHOD_ID_LENGTH = 12
+HISTORY_PAGE_SIZE = int(os.getenv("HISTORY_PAGE_SIZE", "10"))
+HISTORY_FIELDS = {"transaction_type": 1, "method": 1, "currency": 1, "amount": 1, "amount_minor": 1, "timestamp": 1}
+
+
+def _write_stamp():
+    # Every write to a user document records when and by which process it was
+    # made, so other processes can tell which cached users went stale. The
+    # sequence number makes `writer` change on every write, so it always shows
+    # up in a change event's updated fields.
+    return {"updated_at": time.time(), "writer": f"{INSTANCE_ID}/{next(_write_sequence)}"}
 
-def update_balance(user_id):
-    new_balance = calculate_balance(user_id)
-    try:
-        users_collection.update_one({"user_id": user_id}, {"$set": {"balance": new_balance}})
-    except errors.PyMongoError as e:
-        pass
 
+def is_own_write(writer):
+    return bool(writer) and writer.startswith(f"{INSTANCE_ID}/")
 
+
+def _stamped(update):
+    update.setdefault("$set", {}).update(_write_stamp())
+    return update
+
+
+def _balance_stamped(update):
+    # Bot writes that $inc a balance also set balances_updated_at, so that
+    # recompute-balances can tell them apart from state and menu writes.
+    _stamped(update)
+    update["$set"]["balances_updated_at"] = update["$set"]["updated_at"]
+    return update
+
+
+@metrics.timed_db
 def get_user(user_id):
     try:
         user = users_collection.find_one({"user_id": user_id})
         return user
     except errors.PyMongoError as e:
+        metrics.record_db_error("get_user", e)
+        return None
+
+
+@metrics.timed_db
+def get_user_state(user_id):
+    try:
+        user = users_collection.find_one({"user_id": user_id}, {"_id": 0, "state": 1})
+        return (user or {}).get("state", {})
+    except errors.PyMongoError as e:
+        metrics.record_db_error("get_user_state", e)
         return None
 
 
+@metrics.timed_db
 def create_user_if_not_exists(user_id):
     try:
         if not users_collection.find_one({"user_id": user_id}):
-            users_collection.insert_one({"user_id": user_id, "balance": 0, "state": {}})
+            users_collection.insert_one({"user_id": user_id, "balances": {}, "state": {}, **_write_stamp()})
     except errors.PyMongoError as e:
-        pass
+        metrics.record_db_error("create_user_if_not_exists", e)
 
 
+@metrics.timed_db
 def update_user(user_id, user_data):
     update_data = {}
     for key, value in user_data.items():
@@ -48,56 +195,773 @@ def update_user(user_id, user_data):
                 update_data['$set'] = {key: value}
 
     try:
-        users_collection.update_one({"user_id": user_id}, update_data)
+        users_collection.update_one({"user_id": user_id}, _stamped(update_data))
+    except errors.PyMongoError as e:
+        metrics.record_db_error("update_user", e)
+
+
+def payment_method_id(method):
+    """Short deterministic id of a payment method, used for deduplication and in callback data."""
+    key = "\x1f".join([method["type"], method.get("crypto_type") or "", method.get("details", "")])
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()[:PAYMENT_METHOD_ID_LENGTH]
+
+
+def _with_ids(methods):
+    unique = {}
+    for method in methods:
+        method_id = method.get("id") or payment_method_id(method)
+        unique.setdefault(method_id, {**method, "id": method_id})
+    return list(unique.values())
+
+
+@metrics.timed_db
+def add_payment_method(user_id, method_type, details, crypto_type=None):
+    method = {"type": method_type, "details": details}
+    if crypto_type:
+        method["crypto_type"] = crypto_type
+    method["id"] = payment_method_id(method)
+
+    # The $ne filter makes the duplicate check part of the write, so no read
+    # of the saved methods is needed and concurrent adds cannot both succeed.
+    try:
+        result = users_collection.update_one(
+            {"user_id": user_id, "deposit_methods.id": {"$ne": method["id"]}},
+            _stamped({"$push": {"deposit_methods": method}})
+        )
+        return result.modified_count == 1
+    except errors.PyMongoError as e:
+        metrics.record_db_error("add_payment_method", e)
+        return False
+
+
+@metrics.timed_db
+def get_payment_methods(user_id):
+    try:
+        user = users_collection.find_one({"user_id": user_id}, {"_id": 0, "deposit_methods": 1})
+        methods = (user or {}).get("deposit_methods", [])
+        if any("id" not in method for method in methods):
+            methods = _with_ids(methods)
+            users_collection.update_one({"user_id": user_id}, _stamped({"$set": {"deposit_methods": methods}}))
+        return methods
     except errors.PyMongoError as e:
-        pass
+        metrics.record_db_error("get_payment_methods", e)
+        return []
+
+
+@metrics.timed_db
+def get_payment_method(user_id, method_id):
+    try:
+        user = users_collection.find_one(
+            {"user_id": user_id},
+            {"_id": 0, "deposit_methods": {"$elemMatch": {"id": method_id}}}
+        )
+    except errors.PyMongoError as e:
+        metrics.record_db_error("get_payment_method", e)
+        return None
+    methods = (user or {}).get("deposit_methods")
+    return methods[0] if methods else None
 
 
+def backfill_payment_method_ids():
+    """Adds ids to payment methods saved before they had one and drops duplicates."""
+    count = 0
+    for user in users_collection.find({"deposit_methods": {"$elemMatch": {"id": {"$exists": False}}}},
+                                      {"user_id": 1, "deposit_methods": 1}):
+        users_collection.update_one(
+            {"_id": user["_id"]}, _stamped({"$set": {"deposit_methods": _with_ids(user["deposit_methods"])}})
+        )
+        count += 1
+    return count
+
+
+@metrics.timed_db
 def get_transactions(user_id):
     try:
         transactions = list(transactions_collection.find({"user_id": user_id}))
         return transactions
     except errors.PyMongoError as e:
+        metrics.record_db_error("get_transactions", e)
         return []
 
 
-def add_transaction(user_id, transaction_type, method, currency, amount):
-    if not transaction_type or not method or not currency or amount is None:
-        raise ValueError("All transaction details must be provided")
+@metrics.timed_db
+def get_transaction_page(user_id, cursor=None, newer=False, page_size=HISTORY_PAGE_SIZE):
+    # Keyset pagination over (timestamp, _id), newest first. `cursor` is the
+    # (timestamp, _id) of the row next to the requested page, so every page is
+    # a bounded index range scan no matter how long the history is.
+    query = {"user_id": user_id}
+    if cursor:
+        timestamp, transaction_id = cursor
+        operator = "$gt" if newer else "$lt"
+        query["$or"] = [
+            {"timestamp": {operator: timestamp}},
+            {"timestamp": timestamp, "_id": {operator: transaction_id}}
+        ]
+    order = ASCENDING if newer else DESCENDING
+
+    try:
+        rows = list(
+            transactions_collection.find(query, HISTORY_FIELDS)
+            .sort([("timestamp", order), ("_id", order)])
+            .limit(page_size + 1)
+        )
+    except errors.PyMongoError as e:
+        metrics.record_db_error("get_transaction_page", e)
+        return [], False, False
+
+    has_more = len(rows) > page_size
+    rows = rows[:page_size]
+    if newer:
+        rows.reverse()
+        return rows, True, has_more
+    return rows, has_more, cursor is not None
+
+
+def signed_amount(transaction_type, amount):
+    return -amount if transaction_type == "withdraw" else amount
+
+
+def ensure_indexes():
+    users_collection.create_index("user_id", unique=True, name="user_id_unique")
+    transactions_collection.create_index([("user_id", 1), ("timestamp", 1), ("_id", 1)], name="user_id_timestamp_id")
+    transactions_collection.create_index("idempotency_key", unique=True, sparse=True, name="idempotency_key_unique")
+    users_collection.create_index("updated_at", name="updated_at")
+    transactions_collection.create_index("timestamp", name="timestamp")
+    snapshots_collection.create_index([("user_id", 1), ("checkpoint", 1)], unique=True, name="user_id_checkpoint_unique")
+
+
+def _hot_path_queries():
+    return [
+        ("users by user_id", users_collection, {"user_id": 0}, None),
+        ("users by updated_at", users_collection, {"updated_at": {"$gt": time.time()}}, None),
+        ("transactions by user_id", transactions_collection, {"user_id": 0}, [("timestamp", 1)]),
+        ("transaction history page", transactions_collection, {"user_id": 0}, [("timestamp", -1), ("_id", -1)]),
+        ("transactions by idempotency_key", transactions_collection, {"idempotency_key": ""}, None),
+    ]
+
+
+def _plan_stages(plan):
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            yield plan["stage"]
+        for value in plan.values():
+            yield from _plan_stages(value)
+    elif isinstance(plan, list):
+        for item in plan:
+            yield from _plan_stages(item)
+
+
+def verify_index_usage():
+    unindexed = []
+    for name, collection, query, sort in _hot_path_queries():
+        # Cursor.explain() runs the query to completion (allPlansExecution);
+        # only the chosen plan is needed, so ask the planner alone.
+        command = {"find": collection.name, "filter": query}
+        if sort:
+            command["sort"] = dict(sort)
+        explained = collection.database.command("explain", command, verbosity="queryPlanner")
+        winning_plan = explained.get("queryPlanner", {}).get("winningPlan", {})
+        if "COLLSCAN" in set(_plan_stages(winning_plan)):
+            unindexed.append(name)
+    if unindexed:
+        raise RuntimeError(f"Hot-path queries are not using an index: {', '.join(unindexed)}")
+
 
+def _transaction_document(user_id, transaction_type, method, currency, amount, amount_minor, idempotency_key=None):
     transaction = {
         "user_id": user_id,
         "transaction_type": transaction_type,
         "method": method,
         "currency": currency,
-        "amount": amount,
+        "amount": Decimal128(str(amount)),
+        "amount_minor": amount_minor,
         "timestamp": time.time()
     }
+    if idempotency_key:
+        transaction["idempotency_key"] = idempotency_key
+    return transaction
+
+
+class UnitOfWork:
+    """The writes of one interaction: ledger rows, their balance changes and the state reset.
+
+    commit() stores the rows with one insert_many and the balance $inc and
+    state $unset with one update of the user document.
+    """
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.transactions = []
+        self.state_cleared = False
+
+    def add_transaction(self, transaction_type, method, currency, amount, idempotency_key=None):
+        if not transaction_type or not method or not currency or amount is None:
+            raise ValueError("All transaction details must be provided")
+        amount_minor = money.to_minor(currency, amount)
+        self.transactions.append(_transaction_document(
+            self.user_id, transaction_type, method, currency, amount, amount_minor, idempotency_key
+        ))
+
+    def clear_state(self):
+        self.state_cleared = True
+
+    def user_update(self, credited):
+        """The user write for the transactions flagged in `credited`.
+
+        Returns (filter, update). Keyed transactions are only credited if
+        their keys are not in processed_keys yet, and the same write pushes
+        them, so a retried commit never credits a transaction twice.
+        """
+        increments = defaultdict(int)
+        keys = []
+        for transaction, ok in zip(self.transactions, credited):
+            if ok:
+                key = f"balances.{transaction['method']}.{transaction['currency']}"
+                increments[key] += signed_amount(transaction["transaction_type"], transaction["amount_minor"])
+                if transaction.get("idempotency_key"):
+                    keys.append(transaction["idempotency_key"])
+
+        query = {"user_id": self.user_id}
+        update = {}
+        if increments:
+            update["$inc"] = dict(increments)
+        if keys:
+            query["processed_keys"] = {"$nin": keys}
+            update["$push"] = {"processed_keys": {"$each": keys, "$slice": -PROCESSED_KEYS_LIMIT}}
+        if self.state_cleared:
+            update["$unset"] = {"state": ""}
+        return query, update
+
+
+def _check_unit(unit):
+    """Raises ValueError for a unit that could not be stored, before it joins a batch."""
+    _, update = unit.user_update([True] * len(unit.transactions))
+    for value in update.get("$inc", {}).values():
+        if abs(value) > money.MAX_MINOR:
+            raise money.CurrencyError("Transaction amount is too large")
+    for transaction in unit.transactions:
+        try:
+            bson.encode(transaction)
+        except (bson.errors.InvalidDocument, OverflowError) as e:
+            raise ValueError(f"Transaction cannot be stored: {e}")
+
+
+def _commit_units(units):
+    """Commits several units with one insert_many and one bulk_write.
+
+    Returns, for each unit, whether each of its transactions was credited by
+    this call. A keyed row that is already in the ledger (an earlier attempt
+    inserted it) is still credited, guarded by processed_keys, so a commit
+    that failed halfway can simply be retried; rows are never deleted.
+    """
+    documents = [transaction for unit in units for transaction in unit.transactions]
+    credited = [True] * len(documents)
+    if documents:
+        try:
+            transactions_collection.insert_many(documents, ordered=False)
+        except errors.BulkWriteError as e:
+            for error in e.details["writeErrors"]:
+                duplicate = error["code"] == DUPLICATE_KEY_ERROR
+                credited[error["index"]] = duplicate and bool(documents[error["index"]].get("idempotency_key"))
+
+    results = []
+    requests = []
+    request_units = []
+    position = 0
+    for unit in units:
+        unit_credited = credited[position:position + len(unit.transactions)]
+        position += len(unit.transactions)
+        results.append(unit_credited)
+        query, update = unit.user_update(unit_credited)
+        if update:
+            stamp = _balance_stamped if "$inc" in update else _stamped
+            requests.append(UpdateOne(query, stamp(update), upsert=True))
+            request_units.append(len(results) - 1)
+
+    if requests:
+        try:
+            users_collection.bulk_write(requests, ordered=False)
+        except errors.BulkWriteError as e:
+            # An update whose keys were already processed does not match, and
+            # its upsert then fails on the unique user_id.
+            for error in e.details["writeErrors"]:
+                index = request_units[error["index"]]
+                results[index] = [False] * len(units[index].transactions)
+    return results
+
+
+class GroupCommitter:
+    """Coalesces units of work committed by concurrent threads into shared batches.
+
+    The first thread to arrive waits up to `window` seconds (or until
+    `max_batch` units are queued) and commits everything queued so far; the
+    other threads wait for that batch and get their own results back. If the
+    batch as a whole fails, its units are retried one at a time, so one bad
+    unit only fails its own commit.
+    """
+
+    def __init__(self, window=GROUP_COMMIT_WINDOW, max_batch=GROUP_COMMIT_MAX_BATCH):
+        self.window = window
+        self.max_batch = max_batch
+        self._pending = []
+        self._condition = threading.Condition()
 
+    def commit(self, unit):
+        future = Future()
+        with self._condition:
+            self._pending.append((unit, future))
+            leader = len(self._pending) == 1
+            if len(self._pending) >= self.max_batch:
+                self._condition.notify_all()
+
+        if leader:
+            with self._condition:
+                self._condition.wait_for(lambda: len(self._pending) >= self.max_batch, timeout=self.window)
+                batch, self._pending = self._pending, []
+            try:
+                results = _commit_units([unit for unit, _ in batch])
+            except Exception as e:
+                if len(batch) == 1:
+                    batch[0][1].set_exception(e)
+                else:
+                    for queued, waiter in batch:
+                        try:
+                            waiter.set_result(_commit_units([queued])[0])
+                        except Exception as unit_error:
+                            waiter.set_exception(unit_error)
+            else:
+                for (_, waiter), result in zip(batch, results):
+                    waiter.set_result(result)
+
+        return future.result()
+
+
+group_committer = GroupCommitter()
+
+
+@metrics.timed_db
+def commit(unit):
+    _check_unit(unit)
     try:
-        transactions_collection.insert_one(transaction)
-        update_balance(user_id)
+        if GROUP_COMMIT:
+            return group_committer.commit(unit)
+        return _commit_units([unit])[0]
     except errors.PyMongoError as e:
-        pass
+        metrics.record_db_error("commit", e)
+        return [False] * len(unit.transactions)
 
 
-def calculate_balance(user_id):
-    transactions = get_transactions(user_id)
-    balance = 0
-    for transaction in transactions:
-        if transaction["transaction_type"] == "deposit":
-            balance += transaction["amount"]
-        elif transaction["transaction_type"] == "withdrawal":
-            balance -= transaction["amount"]
-    return balance
-
-
-def update_all_balances():
-    users = users_collection.find()
-    for user in users:
-        user_id = user['user_id']
-        new_balance = calculate_balance(user_id)
+@metrics.timed_db
+def is_processed(user_id, idempotency_key):
+    try:
+        return users_collection.count_documents({"user_id": user_id, "processed_keys": idempotency_key}, limit=1) > 0
+    except errors.PyMongoError as e:
+        metrics.record_db_error("is_processed", e)
+        return False
+
+
+def add_transaction(user_id, transaction_type, method, currency, amount, idempotency_key=None):
+    unit = UnitOfWork(user_id)
+    unit.add_transaction(transaction_type, method, currency, amount, idempotency_key)
+    return commit(unit)[0]
+
+
+def _is_transient(error):
+    return isinstance(error, errors.ConnectionFailure) or error.has_error_label("RetryableWriteError")
+
+
+def _record_ledger_row(transaction, retries=LEDGER_WRITE_RETRIES):
+    """Idempotently stores a ledger row by its idempotency key, retrying transient errors."""
+    fields = {key: value for key, value in transaction.items() if key != "idempotency_key"}
+    for attempt in range(retries + 1):
         try:
-            users_collection.update_one({"user_id": user_id}, {"$set": {"balance": new_balance}})
+            transactions_collection.update_one(
+                {"idempotency_key": transaction["idempotency_key"]}, {"$setOnInsert": fields}, upsert=True
+            )
+            return
+        except errors.DuplicateKeyError:
+            # A concurrent upsert of the same key inserted the row first.
+            return
         except errors.PyMongoError as e:
-            pass
+            if attempt == retries or not _is_transient(e):
+                raise
+            time.sleep(0.1 * 2 ** attempt)
+
+
+def _available_balance_expr(method, currency):
+    methods = FIAT_METHODS if method in FIAT_METHODS else [method]
+    return {"$add": [{"$ifNull": [f"$balances.{m}.{currency}", 0]} for m in methods]}
+
+
+@metrics.timed_db
+def withdraw(user_id, method, currency, amount, idempotency_key, clear_state=False):
+    if not method or not currency or not idempotency_key or amount is None or amount <= 0:
+        raise ValueError("All withdrawal details must be provided")
+    amount_minor = money.to_minor(currency, amount)
+
+    update = {
+        "$inc": {f"balances.{method}.{currency}": -amount_minor},
+        "$push": {"processed_keys": {"$each": [idempotency_key], "$slice": -PROCESSED_KEYS_LIMIT}}
+    }
+    if clear_state:
+        update["$unset"] = {"state": ""}
+
+    # The balance check has to happen in the same write as the debit, so
+    # withdrawals are not group committed.
+    result = users_collection.update_one(
+        {
+            "user_id": user_id,
+            "processed_keys": {"$ne": idempotency_key},
+            "$expr": {"$gte": [_available_balance_expr(method, currency), amount_minor]}
+        },
+        _balance_stamped(update)
+    )
+    outcome = WITHDRAW_OK
+    if result.modified_count == 0:
+        if not users_collection.count_documents({"user_id": user_id, "processed_keys": idempotency_key}, limit=1):
+            return WITHDRAW_INSUFFICIENT
+        outcome = WITHDRAW_DUPLICATE
+
+    # The debit is already applied, so the ledger row is written on both paths:
+    # a retry after a failed write sees WITHDRAW_DUPLICATE and completes it.
+    _record_ledger_row(_transaction_document(user_id, "withdraw", method, currency, amount, amount_minor,
+                                             idempotency_key))
+    return outcome
+
+
+@metrics.timed_db
+def get_balances(user_id):
+    try:
+        user = users_collection.find_one({"user_id": user_id}, {"_id": 0, "balances": 1})
+        return (user or {}).get("balances", {})
+    except errors.PyMongoError as e:
+        metrics.record_db_error("get_balances", e)
+        return {}
+
+
+def amount_minor_expr():
+    # Transactions recorded before amounts were stored in minor units only have
+    # `amount` in major units.
+    legacy = {"$switch": {
+        "branches": [
+            {"case": {"$eq": ["$currency", currency]}, "then": {"$multiply": ["$amount", 10 ** digits]}}
+            for currency, digits in money.MINOR_UNITS.items()
+        ],
+        "default": "$amount"
+    }}
+    return {"$toLong": {"$ifNull": ["$amount_minor", legacy]}}
+
+
+def _snapshot_rows(checkpoint, user_match=None):
+    # Unwinds each snapshot's balances into one row per method and currency,
+    # shaped like a transaction so the ledger pipeline can sum it.
+    return [
+        {"$match": {**({"user_id": user_match} if user_match is not None else {}), "checkpoint": checkpoint}},
+        {"$project": {"_id": 0, "user_id": 1, "methods": {"$objectToArray": "$balances"}}},
+        {"$unwind": "$methods"},
+        {"$project": {"user_id": 1, "method": "$methods.k", "currencies": {"$objectToArray": "$methods.v"}}},
+        {"$unwind": "$currencies"},
+        {"$project": {"user_id": 1, "method": 1, "currency": "$currencies.k", "amount_minor": "$currencies.v",
+                      "transaction_type": {"$literal": "snapshot"}}}
+    ]
+
+
+def ledger_balance_pipeline(match=None, checkpoint=None):
+    """Per-user balances from the ledger.
+
+    With a checkpoint, transactions before it are not read: the balances
+    snapshotted at the checkpoint are added to the transactions after it.
+    """
+    match = dict(match or {})
+    user_match = match.get("user_id")
+    stages = []
+    if checkpoint is not None:
+        match["timestamp"] = {**match.get("timestamp", {}), "$gte": checkpoint}
+    stages.append({"$match": {**match, "transaction_type": {"$in": ["deposit", "withdraw"]}}})
+    if checkpoint is not None:
+        stages.append({"$unionWith": {"coll": snapshots_collection.name, "pipeline": _snapshot_rows(checkpoint, user_match)}})
+    return stages + [
+        {"$group": {
+            "_id": {"user_id": "$user_id", "method": "$method", "currency": "$currency"},
+            "amount": {"$sum": {"$cond": [
+                {"$eq": ["$transaction_type", "withdraw"]},
+                {"$multiply": [amount_minor_expr(), -1]},
+                amount_minor_expr()
+            ]}}
+        }},
+        {"$group": {
+            "_id": {"user_id": "$_id.user_id", "method": "$_id.method"},
+            "currencies": {"$push": {"k": "$_id.currency", "v": "$amount"}}
+        }},
+        {"$group": {
+            "_id": "$_id.user_id",
+            "methods": {"$push": {"k": "$_id.method", "v": {"$arrayToObject": "$currencies"}}}
+        }},
+        {"$project": {"_id": 0, "user_id": "$_id", "balances": {"$arrayToObject": "$methods"}}}
+    ]
+
+
+def _non_zero(balances):
+    return {
+        method: {currency: amount for currency, amount in currencies.items() if amount}
+        for method, currencies in (balances or {}).items()
+        if any(currencies.values())
+    }
+
+
+def calculate_balance(user_id):
+    pipeline = ledger_balance_pipeline({"user_id": user_id}, get_ledger_checkpoint())
+    for row in transactions_collection.aggregate(pipeline):
+        return row["balances"]
+    return {}
+
+
+def reconcile_balances(fix=False):
+    mismatches = []
+    seen = set()
+    pipeline = ledger_balance_pipeline(checkpoint=get_ledger_checkpoint()) + [
+        {"$lookup": {"from": users_collection.name, "localField": "user_id", "foreignField": "user_id", "as": "user"}},
+        {"$project": {"user_id": 1, "balances": 1, "user.balances": 1}}
+    ]
+    for row in transactions_collection.aggregate(pipeline, allowDiskUse=True):
+        user_id = row["user_id"]
+        seen.add(user_id)
+        stored = row["user"][0].get("balances", {}) if row["user"] else {}
+        if _non_zero(row["balances"]) != _non_zero(stored):
+            mismatches.append({"user_id": user_id, "expected": row["balances"], "stored": stored})
+
+    for user in users_collection.find({"balances": {"$exists": True}}, {"_id": 0, "user_id": 1, "balances": 1}):
+        if user["user_id"] not in seen and _non_zero(user["balances"]):
+            mismatches.append({"user_id": user["user_id"], "expected": {}, "stored": user["balances"]})
+
+    if fix:
+        for mismatch in mismatches:
+            users_collection.update_one(
+                {"user_id": mismatch["user_id"]},
+                _stamped({"$set": {"balances": mismatch["expected"]}})
+            )
+    return mismatches
+
+
+def _users_with_transactions(since=None, checkpoint=None):
+    pipeline = [{"$group": {"_id": "$user_id"}}]
+    if since is not None:
+        pipeline.insert(0, {"$match": {"timestamp": {"$gte": since}}})
+    elif checkpoint is not None:
+        # Users whose transactions were all archived only appear in the snapshot.
+        pipeline.insert(0, {"$unionWith": {"coll": snapshots_collection.name, "pipeline": [
+            {"$match": {"checkpoint": checkpoint}}, {"$project": {"user_id": 1}}
+        ]}})
+    return [row["_id"] for row in transactions_collection.aggregate(pipeline, allowDiskUse=True)]
+
+
+def update_all_balances(incremental=False, batch_size=RECOMPUTE_BATCH_SIZE, progress=None):
+    """Recomputes stored balances from the ledger.
+
+    Users whose balance the bot changed while their batch was being computed
+    are skipped, since the aggregation may not have seen that change; they
+    are kept in the watermark document and recomputed by the next run.
+    Returns the number of users recomputed.
+    """
+    started_at = time.time()
+    watermark = meta_collection.find_one({"_id": BALANCES_WATERMARK}) or {}
+    since = watermark.get("timestamp") if incremental else None
+    checkpoint = get_ledger_checkpoint()
+    user_ids = _users_with_transactions(since, checkpoint)
+    queued = set(user_ids)
+    user_ids += [user_id for user_id in watermark.get("pending", []) if user_id not in queued]
+    skipped = []
+
+    for done in range(0, len(user_ids), batch_size):
+        batch = user_ids[done:done + batch_size]
+        # A withdrawal debits the balance before writing its ledger row, so
+        # users with a balance write shortly before the batch are skipped too.
+        cutoff = time.time() - BALANCES_WATERMARK_OVERLAP
+        transactions_collection.aggregate(ledger_balance_pipeline({"user_id": {"$in": batch}}, checkpoint) + [
+            {"$addFields": _write_stamp()},
+            {"$merge": {
+                "into": users_collection.name,
+                "on": "user_id",
+                "whenMatched": [{"$replaceWith": {"$mergeObjects": [
+                    "$$ROOT",
+                    {"$cond": [{"$gt": [{"$ifNull": ["$balances_updated_at", 0]}, cutoff]}, {}, "$$new"]}
+                ]}}],
+                "whenNotMatched": "discard"
+            }}
+        ], allowDiskUse=True)
+        skipped += [user["user_id"] for user in users_collection.find(
+            {"user_id": {"$in": batch}, "balances_updated_at": {"$gt": cutoff}}, {"_id": 0, "user_id": 1}
+        )]
+        if progress:
+            progress(done + len(batch), len(user_ids))
+
+    if since is None:
+        users_collection.update_many({"balances": {"$exists": False}}, _stamped({"$set": {"balances": {}}}))
+
+    # Transactions inserted while the job was running are picked up by the next
+    # incremental run; recomputing a user twice is harmless.
+    meta_collection.update_one(
+        {"_id": BALANCES_WATERMARK},
+        {"$set": {"timestamp": started_at - BALANCES_WATERMARK_OVERLAP, "pending": skipped}},
+        upsert=True
+    )
+    return len(user_ids) - len(skipped)
+
+
+def get_ledger_checkpoint():
+    checkpoint = meta_collection.find_one({"_id": LEDGER_CHECKPOINT})
+    return checkpoint["timestamp"] if checkpoint else None
+
+
+def _month_start(timestamp):
+    moment = datetime.fromtimestamp(timestamp, tz=timezone.utc)
+    return datetime(moment.year, moment.month, 1, tzinfo=timezone.utc)
+
+
+def compaction_checkpoint(retention_days=LEDGER_RETENTION_DAYS, now=None):
+    """Start of the month `retention_days` ago, so that archives hold whole months."""
+    return _month_start((now or time.time()) - retention_days * 86400).timestamp()
+
+
+def _next_month(month_start):
+    if month_start.month == 12:
+        return month_start.replace(year=month_start.year + 1, month=1)
+    return month_start.replace(month=month_start.month + 1)
+
+
+def _export_path(export_dir, month, checkpoint):
+    # Every run writes a new part, so an export is never replaced by a re-run
+    # that only sees the rows an interrupted delete left behind.
+    for part in itertools.count(1):
+        path = os.path.join(export_dir, f"transactions_{month}_{int(checkpoint)}_{part:03d}.jsonl.gz")
+        if not os.path.exists(path):
+            return path
+
+
+def _export_month(query, path):
+    partial_path = f"{path}.partial"
+    with gzip.open(partial_path, "wt", encoding="utf-8") as f:
+        for transaction in transactions_collection.find(query).sort("timestamp", ASCENDING):
+            f.write(json_util.dumps(transaction, json_options=json_util.CANONICAL_JSON_OPTIONS) + "\n")
+    os.replace(partial_path, path)
+
+
+def compact_ledger(checkpoint, export_dir=None, progress=None):
+    """Snapshots every balance at `checkpoint` and moves older transactions out of the ledger.
+
+    Older transactions go to one `transactions_archive_YYYYMM` collection per
+    month, or with `export_dir` to gzipped MongoDB Extended JSON files. Each
+    step can be re-run safely if the job is interrupted. Returns the number of
+    archived transactions.
+    """
+    if checkpoint > time.time() - LEDGER_CHECKPOINT_MARGIN:
+        raise ValueError("The checkpoint must be at least a day in the past")
+    previous = get_ledger_checkpoint()
+    if previous is not None and checkpoint < previous:
+        raise ValueError("The ledger is already compacted past this checkpoint")
+
+    if checkpoint != previous:
+        transactions_collection.aggregate(
+            ledger_balance_pipeline({"timestamp": {"$lt": checkpoint}}, previous) + [
+                {"$addFields": {"checkpoint": checkpoint}},
+                {"$merge": {
+                    "into": snapshots_collection.name,
+                    "on": ["user_id", "checkpoint"],
+                    "whenMatched": "replace",
+                    "whenNotMatched": "insert"
+                }}
+            ], allowDiskUse=True)
+        meta_collection.update_one({"_id": LEDGER_CHECKPOINT}, {"$set": {"timestamp": checkpoint}}, upsert=True)
+        snapshots_collection.delete_many({"checkpoint": {"$lt": checkpoint}})
+
+    # Balance reads ignore transactions before the checkpoint from here on, so
+    # they can be moved month by month.
+    archived = 0
+    while True:
+        oldest = transactions_collection.find_one(
+            {"timestamp": {"$lt": checkpoint}}, {"timestamp": 1}, sort=[("timestamp", ASCENDING)]
+        )
+        if oldest is None:
+            return archived
+        month_start = _month_start(oldest["timestamp"])
+        month = month_start.strftime("%Y%m")
+        query = {"timestamp": {"$gte": month_start.timestamp(),
+                               "$lt": min(_next_month(month_start).timestamp(), checkpoint)}}
+
+        if export_dir:
+            _export_month(query, _export_path(export_dir, month, checkpoint))
+        else:
+            transactions_collection.aggregate([
+                {"$match": query},
+                {"$merge": {
+                    "into": ARCHIVE_COLLECTION_PREFIX + month,
+                    "on": "_id",
+                    "whenMatched": "keepExisting",
+                    "whenNotMatched": "insert"
+                }}
+            ], allowDiskUse=True)
+        deleted = transactions_collection.delete_many(query).deleted_count
+        archived += deleted
+        if progress:
+            progress(month, deleted)
+
+
+def watch_users(resume_after=None):
+    """Opens a change stream of user document writes; needs a replica set or sharded cluster."""
+    pipeline = [
+        {"$match": {"operationType": {"$in": ["insert", "update", "replace"]}}},
+        {"$project": {"operationType": 1, "fullDocument.user_id": 1, "fullDocument.writer": 1,
+                      "updateDescription.updatedFields.writer": 1}}
+    ]
+    return users_collection.watch(pipeline, full_document="updateLookup", resume_after=resume_after,
+                                  max_await_time_ms=1000)
+
+
+def changed_users(since, limit=0):
+    """Users written by other processes after `since`, for deployments without change streams.
+
+    Returns at most `limit` users (0 means no limit), oldest writes first.
+    """
+    return list(users_collection.find(
+        {"updated_at": {"$gt": since}, "writer": {"$not": re.compile(f"^{re.escape(INSTANCE_ID)}/")}},
+        USER_CHANGE_FIELDS
+    ).sort("updated_at", ASCENDING).limit(limit))
+
+
+@metrics.timed_db
+def acquire_lease(name, owner, ttl, address=None):
+    now = time.time()
+    try:
+        lease = leases_collection.find_one_and_update(
+            {"_id": name, "$or": [{"owner": owner}, {"expires_at": {"$lt": now}}]},
+            {"$set": {"owner": owner, "address": address, "expires_at": now + ttl}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        return lease is not None and lease["owner"] == owner
+    except errors.DuplicateKeyError as e:
+        return False
+    except errors.PyMongoError as e:
+        # None rather than False: the lease may still be ours, we just could
+        # not renew it.
+        metrics.record_db_error("acquire_lease", e)
+        return None
+
+
+@metrics.timed_db
+def release_lease(name, owner):
+    try:
+        leases_collection.delete_one({"_id": name, "owner": owner})
+    except errors.PyMongoError as e:
+        metrics.record_db_error("release_lease", e)
+
+
+@metrics.timed_db
+def get_active_leases(prefix):
+    try:
+        return list(leases_collection.find(
+            {"_id": {"$regex": f"^{re.escape(prefix)}"}, "expires_at": {"$gte": time.time()}}
+        ))
+    except errors.PyMongoError as e:
+        metrics.record_db_error("get_active_leases", e)
+        return []
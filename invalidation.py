@@ -0,0 +1,128 @@
+import asyncio
+import os
+import threading
+import time
+
+from pymongo import errors
+
+import database
+
+CACHE_INVALIDATION = os.getenv("CACHE_INVALIDATION", "auto")
+INVALIDATION_POLL_INTERVAL = float(os.getenv("INVALIDATION_POLL_INTERVAL", "1"))
+INVALIDATION_POLL_OVERLAP = float(os.getenv("INVALIDATION_POLL_OVERLAP", "5"))
+INVALIDATION_POLL_LIMIT = int(os.getenv("INVALIDATION_POLL_LIMIT", "1000"))
+INVALIDATION_RETRY_DELAY = 5
+
+# Raised by servers that cannot open change streams (standalone mongod).
+CHANGE_STREAMS_UNSUPPORTED = {40573, 40324}
+
+
+class CacheInvalidator:
+    """Evicts cached users that other processes (replicas, manage.py) have written.
+
+    Changes are read from a change stream on the users collection, or, when
+    the server does not support change streams, by polling users by their
+    `updated_at`. Writes made by this process are skipped, since its caches
+    already reflect them. Runs on a background thread and hands the user ids
+    to the event loop, where `on_change(user_id)` is called; `on_reset()` is
+    called when changes may have been missed and every cached user is suspect.
+    """
+
+    def __init__(self, on_change, on_reset, mode=CACHE_INVALIDATION, poll_interval=INVALIDATION_POLL_INTERVAL,
+                 poll_overlap=INVALIDATION_POLL_OVERLAP, poll_limit=INVALIDATION_POLL_LIMIT):
+        self.on_change = on_change
+        self.on_reset = on_reset
+        self.mode = mode
+        self.poll_interval = poll_interval
+        self.poll_overlap = poll_overlap
+        self.poll_limit = poll_limit
+        self._loop = None
+        self._thread = None
+        self._stopped = threading.Event()
+
+    def start(self):
+        if self.mode == "off" or self._thread is not None:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name="cache-invalidation", daemon=True)
+        self._thread.start()
+
+    async def stop(self):
+        if self._thread is None:
+            return
+        self._stopped.set()
+        await asyncio.get_running_loop().run_in_executor(None, self._thread.join)
+        self._thread = None
+
+    def _notify(self, callback, *args):
+        self._loop.call_soon_threadsafe(callback, *args)
+
+    def _run(self):
+        if self.mode in ("auto", "change_stream"):
+            try:
+                self._watch()
+                return
+            except errors.OperationFailure as e:
+                if self.mode == "change_stream" or e.code not in CHANGE_STREAMS_UNSUPPORTED:
+                    raise
+                print("Change streams are not supported by this server. Polling for user changes instead.")
+        self._poll()
+
+    def _watch(self):
+        resume_token = None
+        while not self._stopped.is_set():
+            try:
+                with database.watch_users(resume_after=resume_token) as stream:
+                    while not self._stopped.is_set():
+                        change = stream.try_next()
+                        if change is None:
+                            continue
+                        resume_token = stream.resume_token
+                        self._handle_change(change)
+            except errors.OperationFailure as e:
+                if resume_token is None and e.code in CHANGE_STREAMS_UNSUPPORTED:
+                    raise
+                print(f"Error in the users change stream: {e}")
+                resume_token = None
+                self._notify(self.on_reset)
+                self._stopped.wait(INVALIDATION_RETRY_DELAY)
+            except errors.PyMongoError as e:
+                # The stream resumes from the last token, so nothing is missed.
+                print(f"Error in the users change stream: {e}")
+                self._stopped.wait(INVALIDATION_RETRY_DELAY)
+
+    def _handle_change(self, change):
+        document = change.get("fullDocument") or {}
+        if change["operationType"] == "update":
+            writer = change.get("updateDescription", {}).get("updatedFields", {}).get("writer")
+        else:
+            writer = document.get("writer")
+        if "user_id" in document and not database.is_own_write(writer):
+            self._notify(self.on_change, document["user_id"])
+
+    def _poll(self):
+        since = time.time() - self.poll_overlap
+        seen = {}
+        while not self._stopped.wait(self.poll_interval):
+            try:
+                # Timestamps come from the writers' clocks, so the query looks
+                # back by poll_overlap; `seen` drops the repeats this causes.
+                started_at = time.time()
+                users = database.changed_users(since - self.poll_overlap, self.poll_limit)
+                if len(users) >= self.poll_limit:
+                    # Too many changes to evict one by one (e.g. after a bulk
+                    # job): drop every cached user and start from now.
+                    self._notify(self.on_reset)
+                    since = started_at
+                    seen = {}
+                    continue
+                for user in users:
+                    if seen.get(user["user_id"]) != user["updated_at"]:
+                        seen[user["user_id"]] = user["updated_at"]
+                        self._notify(self.on_change, user["user_id"])
+                since = started_at
+                horizon = since - 2 * self.poll_overlap
+                seen = {user_id: updated_at for user_id, updated_at in seen.items() if updated_at > horizon}
+            except errors.PyMongoError as e:
+                print(f"Error polling for user changes: {e}")
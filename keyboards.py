@@ -0,0 +1,92 @@
+import os
+from collections import OrderedDict
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+PAYMENT_KEYBOARD_CACHE_SIZE = int(os.getenv("PAYMENT_KEYBOARD_CACHE_SIZE", "10000"))
+
+
+def build_menu(buttons, n_cols):
+    return [buttons[i:i + n_cols] for i in range(0, len(buttons), n_cols)]
+
+
+def _markup(buttons, n_cols=1):
+    return InlineKeyboardMarkup(build_menu(buttons, n_cols))
+
+
+# Static menus are built once at import. InlineKeyboardMarkup is immutable,
+# so the same instance can be sent to every user.
+MAIN_MENU = _markup([
+    InlineKeyboardButton("Check Balance", callback_data='check_balance'),
+    InlineKeyboardButton("Deposit", callback_data='deposit'),
+    InlineKeyboardButton("Withdraw", callback_data='withdraw'),
+    InlineKeyboardButton("History", callback_data='history'),
+    InlineKeyboardButton('Cancel', callback_data='cancel')
+])
+
+BACK_TO_MENU_BUTTON = InlineKeyboardButton("Back to Main Menu", callback_data='back_to_menu')
+BACK_TO_MENU = _markup([BACK_TO_MENU_BUTTON])
+
+METHOD_TYPES = _markup([
+    InlineKeyboardButton("Bank Transfer", callback_data='bank_transfer'),
+    InlineKeyboardButton("Paypal", callback_data='paypal'),
+    InlineKeyboardButton("Crypto", callback_data='crypto'),
+    InlineKeyboardButton('Cancel', callback_data='cancel')
+])
+
+CRYPTO_TYPES = _markup([
+    InlineKeyboardButton("BTC", callback_data='btc'),
+    InlineKeyboardButton("ETH", callback_data='eth'),
+    InlineKeyboardButton("USDT", callback_data='usdt'),
+    InlineKeyboardButton('Cancel', callback_data='cancel')
+])
+
+CONFIRM = _markup([
+    InlineKeyboardButton("Yes", callback_data='confirm_yes'),
+    InlineKeyboardButton("No", callback_data='confirm_no')
+], 2)
+
+_PAYMENT_METHOD_FOOTER = [
+    InlineKeyboardButton("Add Payment Method", callback_data='add_payment_method'),
+    InlineKeyboardButton("Cancel", callback_data='cancel')
+]
+
+
+class PaymentMethodKeyboards:
+    """LRU of each user's "Select a payment method" keyboard.
+
+    Entries are dropped with invalidate() whenever the user's saved methods
+    change, so a hit also saves the MongoDB read of the methods.
+    """
+
+    def __init__(self, max_size=PAYMENT_KEYBOARD_CACHE_SIZE):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+
+    def get(self, user_id):
+        reply_markup = self._entries.get(user_id)
+        if reply_markup is not None:
+            self._entries.move_to_end(user_id)
+        return reply_markup
+
+    def build(self, user_id, methods):
+        buttons = [
+            InlineKeyboardButton(f"{method['type']} ({method.get('details', '')})",
+                                 callback_data=f"use_method_{method['id']}")
+            for method in methods
+        ]
+        reply_markup = _markup(buttons + _PAYMENT_METHOD_FOOTER)
+        self._entries[user_id] = reply_markup
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+        return reply_markup
+
+    def invalidate(self, user_id):
+        self._entries.pop(user_id, None)
+
+    def clear(self):
+        self._entries.clear()
+
+
+payment_method_keyboards = PaymentMethodKeyboards()
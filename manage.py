@@ -0,0 +1,108 @@
+import argparse
+import os
+import sys
+from datetime import datetime, timezone
+
+import database
+
+
+def reconcile(args):
+    mismatches = database.reconcile_balances(fix=args.fix)
+    for mismatch in mismatches:
+        print(f"user {mismatch['user_id']}: stored={mismatch['stored']} ledger={mismatch['expected']}")
+    action = "fixed" if args.fix else "found"
+    print(f"{len(mismatches)} balance mismatch(es) {action}.")
+    return 1 if mismatches and not args.fix else 0
+
+
+def recompute_balances(args):
+    def report(done, total):
+        print(f"{done}/{total} users recomputed")
+
+    count = database.update_all_balances(incremental=not args.full, batch_size=args.batch_size, progress=report)
+    print(f"Recomputed balances for {count} user(s).")
+    return 0
+
+
+def indexes(args):
+    database.ensure_indexes()
+    database.verify_index_usage()
+    print("Indexes are in place and used by the hot-path queries.")
+    return 0
+
+
+def backfill_method_ids(args):
+    count = database.backfill_payment_method_ids()
+    print(f"Added payment method ids for {count} user(s).")
+    return 0
+
+
+def compact_ledger(args):
+    if args.before:
+        checkpoint = datetime.strptime(args.before, "%Y-%m-%d").replace(tzinfo=timezone.utc).timestamp()
+    else:
+        checkpoint = database.compaction_checkpoint(args.retention_days)
+    if args.export_dir:
+        os.makedirs(args.export_dir, exist_ok=True)
+
+    def report(month, count):
+        print(f"{month}: {count} transaction(s) archived")
+
+    try:
+        count = database.compact_ledger(checkpoint, export_dir=args.export_dir, progress=report)
+    except ValueError as e:
+        print(e)
+        return 1
+    print(f"Ledger compacted at {datetime.fromtimestamp(checkpoint, tz=timezone.utc):%Y-%m-%d}, "
+          f"{count} transaction(s) archived.")
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Maintenance jobs for the bot database.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    reconcile_parser = subparsers.add_parser(
+        "reconcile", help="Check materialized user balances against the transaction ledger."
+    )
+    reconcile_parser.add_argument("--fix", action="store_true", help="Overwrite mismatched balances with ledger totals.")
+    reconcile_parser.set_defaults(func=reconcile)
+
+    recompute_parser = subparsers.add_parser(
+        "recompute-balances", help="Rebuild materialized balances from the ledger with server-side aggregation."
+    )
+    recompute_parser.add_argument(
+        "--full", action="store_true", help="Recompute every user instead of only those with new transactions."
+    )
+    recompute_parser.add_argument("--batch-size", type=int, default=database.RECOMPUTE_BATCH_SIZE)
+    recompute_parser.set_defaults(func=recompute_balances)
+
+    indexes_parser = subparsers.add_parser(
+        "indexes", help="Create the required indexes and check that hot-path queries use them."
+    )
+    indexes_parser.set_defaults(func=indexes)
+
+    backfill_parser = subparsers.add_parser(
+        "backfill-method-ids", help="Give payment methods saved by older versions their fingerprint id."
+    )
+    backfill_parser.set_defaults(func=backfill_method_ids)
+
+    compact_parser = subparsers.add_parser(
+        "compact-ledger", help="Snapshot balances and move old transactions to monthly archives."
+    )
+    compact_parser.add_argument(
+        "--retention-days", type=int, default=database.LEDGER_RETENTION_DAYS,
+        help="Keep at least this many days of transactions in the ledger (rounded down to a month start)."
+    )
+    compact_parser.add_argument("--before", help="Archive transactions before this UTC date (YYYY-MM-DD) instead.")
+    compact_parser.add_argument(
+        "--export-dir", help="Write archived months to gzipped JSON files in this directory instead of collections."
+    )
+    compact_parser.set_defaults(func=compact_ledger)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,208 @@
+import asyncio
+import os
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from pymongo import monitoring
+
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Counter:
+    def __init__(self, name, description, label):
+        self.name = name
+        self.description = description
+        self.label = label
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, label_value, amount=1):
+        with self._lock:
+            self.values[label_value] = self.values.get(label_value, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for label_value, value in sorted(self.values.items()):
+                lines.append(f'{self.name}{{{self.label}="{label_value}"}} {value}')
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, description, label, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.description = description
+        self.label = label
+        self.buckets = buckets
+        self.series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, label_value, seconds):
+        with self._lock:
+            series = self.series.get(label_value)
+            if series is None:
+                series = self.series[label_value] = {"counts": [0] * len(self.buckets), "count": 0, "sum": 0.0}
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    series["counts"][i] += 1
+                    break
+            series["count"] += 1
+            series["sum"] += seconds
+
+    def quantile(self, label_value, q):
+        # Upper bound of the bucket holding the q-quantile, like histogram_quantile without interpolation.
+        with self._lock:
+            series = self.series.get(label_value)
+            if not series or not series["count"]:
+                return 0.0
+            rank = q * series["count"]
+            cumulative = 0
+            for bound, count in zip(self.buckets, series["counts"]):
+                cumulative += count
+                if cumulative >= rank:
+                    return bound
+            return float("inf")
+
+    def summary(self):
+        with self._lock:
+            return {label_value: (series["count"], series["sum"]) for label_value, series in self.series.items()}
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for label_value, series in sorted(self.series.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets, series["counts"]):
+                    cumulative += count
+                    lines.append(f'{self.name}_bucket{{{self.label}="{label_value}",le="{bound}"}} {cumulative}')
+                lines.append(f'{self.name}_bucket{{{self.label}="{label_value}",le="+Inf"}} {series["count"]}')
+                lines.append(f'{self.name}_sum{{{self.label}="{label_value}"}} {series["sum"]}')
+                lines.append(f'{self.name}_count{{{self.label}="{label_value}"}} {series["count"]}')
+        return lines
+
+
+handler_latency = Histogram("bot_handler_latency_seconds", "Time spent handling an update, by flow step.", "step")
+handler_errors = Counter("bot_handler_errors_total", "Errors raised while handling an update, by flow step.", "step")
+db_call_latency = Histogram("bot_db_call_latency_seconds", "Latency of data layer calls.", "operation")
+db_call_errors = Counter("bot_db_call_errors_total", "MongoDB errors raised inside data layer calls.", "operation")
+db_round_trips = Counter("bot_db_round_trips_total", "Commands sent to MongoDB, by command name.", "command")
+db_command_latency = Histogram("bot_db_command_latency_seconds", "MongoDB command round-trip time.", "command")
+db_command_failures = Counter("bot_db_command_failures_total", "MongoDB commands that failed.", "command")
+
+startup_duration = Histogram("bot_startup_phase_seconds", "Time spent in each startup phase.", "phase")
+REGISTRY = [handler_latency, handler_errors, db_call_latency, db_call_errors, db_round_trips, db_command_latency,
+            db_command_failures, startup_duration]
+
+
+class CommandMetrics(monitoring.CommandListener):
+    def started(self, event):
+        db_round_trips.inc(event.command_name)
+
+    def succeeded(self, event):
+        db_command_latency.observe(event.command_name, event.duration_micros / 1_000_000)
+
+    def failed(self, event):
+        db_command_latency.observe(event.command_name, event.duration_micros / 1_000_000)
+        db_command_failures.inc(event.command_name)
+
+
+def timed_db(func):
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            db_call_latency.observe(func.__name__, time.perf_counter() - started)
+
+    return wrapper
+
+
+def record_db_error(operation, error):
+    db_call_errors.inc(operation)
+    print(f"MongoDB error in {operation}: {error}")
+
+
+@contextmanager
+def track_handler(step):
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        handler_errors.inc(step)
+        raise
+    finally:
+        handler_latency.observe(step, time.perf_counter() - started)
+
+
+@contextmanager
+def track_startup(phase):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        startup_duration.observe(phase, time.perf_counter() - started)
+
+
+def record_handler_error(step, error):
+    handler_errors.inc(step)
+    print(f"Error in {step}: {error}")
+
+
+def render():
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+def _format_table(histogram, errors, limit):
+    rows = sorted(histogram.summary().items(), key=lambda item: -item[1][1])[:limit]
+    lines = []
+    for label_value, (count, total) in rows:
+        line = (f"{label_value}: {count} calls, avg {total / count * 1000:.1f} ms, "
+                f"p95 <= {histogram.quantile(label_value, 0.95) * 1000:.0f} ms")
+        if errors is not None and errors.values.get(label_value):
+            line += f", {errors.values[label_value]} errors"
+        lines.append(line)
+    return lines
+
+
+def stats_text(limit=10):
+    sections = [
+        ("Slowest handler steps (by total time)", _format_table(handler_latency, handler_errors, limit)),
+        ("Slowest data layer calls (by total time)", _format_table(db_call_latency, db_call_errors, limit)),
+        ("MongoDB round-trips", [f"{command}: {count}" for command, count in
+                                 sorted(db_round_trips.values.items(), key=lambda item: -item[1])[:limit]]),
+    ]
+    return "\n\n".join(f"{title}:\n" + ("\n".join(lines) if lines else "no data yet") for title, lines in sections)
+
+
+async def _serve(reader, writer):
+    try:
+        request_line = await reader.readline()
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass
+        parts = request_line.decode("latin-1").split()
+        if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+            status, body = "200 OK", render()
+        else:
+            status, body = "404 Not Found", "not found\n"
+        payload = body.encode()
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n"
+            f"Content-Length: {len(payload)}\r\nConnection: close\r\n\r\n".encode() + payload
+        )
+        await writer.drain()
+    finally:
+        writer.close()
+
+
+async def start_server(host=METRICS_HOST, port=METRICS_PORT):
+    if not port:
+        return None
+    return await asyncio.start_server(_serve, host, port)
@@ -0,0 +1,130 @@
+import importlib
+import json
+import os
+import threading
+import time
+from decimal import ROUND_FLOOR, Decimal, InvalidOperation
+
+BASE_CURRENCY = "USD"
+RATES_PROVIDER = os.getenv("RATES_PROVIDER", "money:FileRateProvider")
+RATES_FILE = os.getenv("RATES_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "rates.json"))
+RATES_TTL = float(os.getenv("RATES_TTL", "60"))
+
+# Number of decimal places of each currency's smallest unit. Amounts are stored
+# as integers of that unit (cents, satoshi, gwei, ...) so that ledger sums and
+# $inc updates are exact and fit in a 64-bit integer.
+MINOR_UNITS = {
+    "USD": 2,
+    "BTC": 8,
+    "ETH": 9,
+    "USDT": 6,
+}
+# Largest amount_minor that fits the int64 fields and $inc updates.
+MAX_MINOR = 2 ** 63 - 1
+# Largest amount parse_amount accepts: one that fits in minor units of every
+# supported currency, since the currency is often chosen after the amount.
+MAX_AMOUNT = Decimal(MAX_MINOR).scaleb(-max(MINOR_UNITS.values())).to_integral_value(rounding=ROUND_FLOOR)
+
+
+class CurrencyError(ValueError):
+    pass
+
+
+def exponent(currency):
+    try:
+        return MINOR_UNITS[currency]
+    except KeyError:
+        raise CurrencyError(f"Unsupported currency: {currency}")
+
+
+def parse_amount(text):
+    try:
+        amount = Decimal(text.strip())
+    except (InvalidOperation, AttributeError):
+        return None
+    if not amount.is_finite() or amount <= 0 or amount > MAX_AMOUNT:
+        return None
+    return amount
+
+
+def to_minor(currency, amount):
+    scaled = Decimal(amount).scaleb(exponent(currency))
+    if scaled != scaled.to_integral_value():
+        raise CurrencyError(f"{currency} amounts have at most {exponent(currency)} decimal places")
+    if abs(scaled) > MAX_MINOR:
+        raise CurrencyError(f"{currency} amount is too large")
+    return int(scaled)
+
+
+def from_minor(currency, amount_minor):
+    return Decimal(amount_minor).scaleb(-exponent(currency))
+
+
+def format_amount(currency, amount):
+    return f"{Decimal(amount).quantize(Decimal(1).scaleb(-exponent(currency))):f}"
+
+
+class FileRateProvider:
+    """Reads rates from a JSON file: {"base": "USD", "rates": {"BTC": "65000.00", ...}}."""
+
+    def __init__(self, path=RATES_FILE):
+        self.path = path
+
+    def fetch(self):
+        with open(self.path) as f:
+            data = json.load(f)
+        if data.get("base", BASE_CURRENCY) != BASE_CURRENCY:
+            raise CurrencyError(f"Rates in {self.path} are not quoted in {BASE_CURRENCY}")
+        return {currency: Decimal(str(rate)) for currency, rate in data["rates"].items()}
+
+
+def load_provider(spec=RATES_PROVIDER):
+    module_name, _, class_name = spec.partition(":")
+    return getattr(importlib.import_module(module_name), class_name)()
+
+
+class RateCache:
+    def __init__(self, provider=None, ttl=RATES_TTL):
+        self._provider = provider
+        self.ttl = ttl
+        self._rates = None
+        self._expires_at = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def provider(self):
+        if self._provider is None:
+            self._provider = load_provider()
+        return self._provider
+
+    def rates(self):
+        with self._lock:
+            if self._rates is None or time.monotonic() >= self._expires_at:
+                rates = self.provider.fetch()
+                rates[BASE_CURRENCY] = Decimal(1)
+                self._rates = rates
+                self._expires_at = time.monotonic() + self.ttl
+            return self._rates
+
+
+rate_cache = RateCache()
+
+
+def value_holdings(holdings_batch, rates=None):
+    """Values many {currency: amount} holdings in BASE_CURRENCY with one rate lookup.
+
+    Returns (total, unpriced currencies) per holding, in the order given.
+    """
+    rates = rates if rates is not None else rate_cache.rates()
+    results = []
+    for holdings in holdings_batch:
+        total = Decimal(0)
+        unpriced = []
+        for currency, amount in holdings.items():
+            rate = rates.get(currency)
+            if rate is None:
+                unpriced.append(currency)
+            else:
+                total += Decimal(amount) * rate
+        results.append((total, unpriced))
+    return results
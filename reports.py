@@ -0,0 +1,282 @@
+import argparse
+import csv
+import math
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+
+import database
+import money
+
+REPORT_BATCH_SIZE = int(os.getenv("REPORT_BATCH_SIZE", "10000"))
+REPORT_WORKERS = int(os.getenv("REPORT_WORKERS", str(os.cpu_count() or 1)))
+DAY = 86400
+
+COLUMNS = {
+    "daily-volume": [
+        ("day", "string"), ("method", "string"), ("currency", "string"), ("deposits", "int64"),
+        ("deposit_volume", "string"), ("withdrawals", "int64"), ("withdrawal_volume", "string"),
+    ],
+    "top-depositors": [
+        ("currency", "string"), ("rank", "int64"), ("user_id", "int64"), ("deposits", "int64"),
+        ("deposit_volume", "string"),
+    ],
+    "reconciliation": [
+        ("user_id", "int64"), ("method", "string"), ("currency", "string"), ("ledger", "string"),
+        ("stored", "string"), ("difference", "string"),
+    ],
+}
+
+
+def _amount(currency, amount_minor):
+    try:
+        return f"{money.from_minor(currency, amount_minor):f}"
+    except money.CurrencyError:
+        return str(amount_minor)
+
+
+def _count_if(transaction_type, value):
+    return {"$sum": {"$cond": [{"$eq": ["$transaction_type", transaction_type]}, value, 0]}}
+
+
+def daily_volume_rows(task, batch_size):
+    start, end = task
+    pipeline = [
+        {"$match": {"timestamp": {"$gte": start, "$lt": end}, "transaction_type": {"$in": ["deposit", "withdraw"]}}},
+        {"$group": {
+            "_id": {
+                "day": {"$subtract": ["$timestamp", {"$mod": ["$timestamp", DAY]}]},
+                "method": "$method",
+                "currency": "$currency"
+            },
+            "deposits": _count_if("deposit", 1),
+            "deposit_volume": _count_if("deposit", database.amount_minor_expr()),
+            "withdrawals": _count_if("withdraw", 1),
+            "withdrawal_volume": _count_if("withdraw", database.amount_minor_expr())
+        }},
+        {"$sort": {"_id.day": 1, "_id.method": 1, "_id.currency": 1}}
+    ]
+    for row in database.transactions_collection.aggregate(pipeline, allowDiskUse=True, batchSize=batch_size):
+        key = row["_id"]
+        day = datetime.fromtimestamp(key["day"], tz=timezone.utc).strftime("%Y-%m-%d")
+        yield (day, key["method"], key["currency"], row["deposits"],
+               _amount(key["currency"], row["deposit_volume"]), row["withdrawals"],
+               _amount(key["currency"], row["withdrawal_volume"]))
+
+
+def top_depositors_rows(task, batch_size):
+    currency, start, end, limit = task
+    pipeline = [
+        {"$match": {"timestamp": {"$gte": start, "$lt": end}, "transaction_type": "deposit", "currency": currency}},
+        {"$group": {"_id": "$user_id", "deposits": {"$sum": 1}, "volume": {"$sum": database.amount_minor_expr()}}},
+        {"$sort": {"volume": -1, "_id": 1}},
+        {"$limit": limit}
+    ]
+    cursor = database.transactions_collection.aggregate(pipeline, allowDiskUse=True, batchSize=batch_size)
+    for rank, row in enumerate(cursor, 1):
+        yield currency, rank, row["_id"], row["deposits"], _amount(currency, row["volume"])
+
+
+def reconciliation_rows(task, batch_size):
+    partition, partitions, mismatches_only = task
+    pipeline = database.ledger_balance_pipeline(
+        {"user_id": {"$mod": [partitions, partition]}}, database.get_ledger_checkpoint()
+    ) + [
+        {"$lookup": {"from": database.users_collection.name, "localField": "user_id", "foreignField": "user_id",
+                     "as": "user"}},
+        {"$project": {"user_id": 1, "balances": 1, "stored": {"$first": "$user.balances"}}}
+    ]
+    seen = set()
+    for row in database.transactions_collection.aggregate(pipeline, allowDiskUse=True, batchSize=batch_size):
+        seen.add(row["user_id"])
+        yield from _balance_rows(row["user_id"], row["balances"], row.get("stored") or {}, mismatches_only)
+
+    # Users with a stored balance but no ledger rows, as in database.reconcile_balances.
+    users = database.users_collection.find(
+        {"user_id": {"$mod": [partitions, partition]}, "balances": {"$exists": True}},
+        {"_id": 0, "user_id": 1, "balances": 1}, batch_size=batch_size
+    )
+    for user in users:
+        if user["user_id"] not in seen:
+            yield from _balance_rows(user["user_id"], {}, user["balances"], mismatches_only)
+
+
+def _balance_rows(user_id, ledger, stored, mismatches_only):
+    for method in sorted(ledger.keys() | stored.keys()):
+        for currency in sorted(ledger.get(method, {}).keys() | stored.get(method, {}).keys()):
+            expected = ledger.get(method, {}).get(currency, 0)
+            actual = stored.get(method, {}).get(currency, 0)
+            if mismatches_only and expected == actual:
+                continue
+            yield (user_id, method, currency, _amount(currency, expected), _amount(currency, actual),
+                   _amount(currency, actual - expected))
+
+
+ROWS = {
+    "daily-volume": daily_volume_rows,
+    "top-depositors": top_depositors_rows,
+    "reconciliation": reconciliation_rows,
+}
+
+
+class CsvWriter:
+    def __init__(self, path, columns, header=True):
+        self._file = open(path, "w", newline="")
+        self._writer = csv.writer(self._file)
+        if header:
+            self._writer.writerow([name for name, _ in columns])
+
+    def write(self, rows):
+        self._writer.writerows(rows)
+
+    def close(self):
+        self._file.close()
+
+
+class ParquetWriter:
+    def __init__(self, path, columns, header=True):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise SystemExit("pyarrow is required for Parquet output: pip install pyarrow")
+        self._pa = pa
+        self.schema = pa.schema([(name, getattr(pa, kind)()) for name, kind in columns])
+        self._writer = pq.ParquetWriter(path, self.schema)
+
+    def write(self, rows):
+        columns = list(zip(*rows))
+        self._writer.write_table(self._pa.Table.from_arrays(
+            [self._pa.array(values, type=field.type) for values, field in zip(columns, self.schema)],
+            schema=self.schema
+        ))
+
+    def write_part(self, path):
+        import pyarrow.parquet as pq
+        for batch in pq.ParquetFile(path).iter_batches():
+            self._writer.write_batch(batch)
+
+    def close(self):
+        self._writer.close()
+
+
+WRITERS = {"csv": CsvWriter, "parquet": ParquetWriter}
+
+
+def run_task(report, task, path, output_format, batch_size):
+    """Runs one slice of a report in a worker process and writes it to `path`.
+
+    The aggregation cursor is read `batch_size` rows at a time and every batch
+    is written out before the next one is fetched, so memory stays bounded.
+    """
+    writer = WRITERS[output_format](path, COLUMNS[report], header=False)
+    count = 0
+    batch = []
+    try:
+        for row in ROWS[report](task, batch_size):
+            batch.append(row)
+            if len(batch) >= batch_size:
+                writer.write(batch)
+                count += len(batch)
+                batch = []
+        if batch:
+            writer.write(batch)
+            count += len(batch)
+    finally:
+        writer.close()
+    return count
+
+
+def _day_start(timestamp):
+    return math.floor(timestamp / DAY) * DAY
+
+
+def time_ranges(start, end, parts):
+    """Splits [start, end) into up to `parts` ranges on UTC day boundaries."""
+    first_day, last_day = _day_start(start), _day_start(end - 1) + DAY
+    days = int((last_day - first_day) // DAY)
+    step = max(1, math.ceil(days / parts))
+    return [(max(start, first_day + i * DAY), min(end, first_day + (i + step) * DAY)) for i in range(0, days, step)]
+
+
+def _parse_date(value):
+    return datetime.strptime(value, "%Y-%m-%d").replace(tzinfo=timezone.utc).timestamp()
+
+
+def report_tasks(args):
+    start = _parse_date(args.start) if args.start else None
+    end = _parse_date(args.end) if args.end else time.time()
+    if args.report == "reconciliation":
+        return [(partition, args.workers, args.mismatches_only) for partition in range(args.workers)]
+
+    if start is None:
+        oldest = database.transactions_collection.find_one({}, {"timestamp": 1}, sort=[("timestamp", 1)])
+        start = oldest["timestamp"] if oldest else end
+    if args.report == "top-depositors":
+        return [(currency, start, end, args.limit) for currency in money.MINOR_UNITS]
+    if start >= end:
+        return []
+    # More ranges than workers, so that busy days do not leave workers idle.
+    return time_ranges(start, end, args.workers * 4)
+
+
+def run_report(args):
+    tasks = report_tasks(args)
+    output_dir = os.path.dirname(os.path.abspath(args.output))
+    started = time.perf_counter()
+    count = 0
+
+    with tempfile.TemporaryDirectory(dir=output_dir) as parts_dir:
+        paths = [os.path.join(parts_dir, f"part-{i:05d}") for i in range(len(tasks))]
+        # Workers are spawned rather than forked, so each one creates its own
+        # MongoClient instead of inheriting the parent's sockets.
+        with ProcessPoolExecutor(max_workers=args.workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+            counts = pool.map(run_task, [args.report] * len(tasks), tasks, paths, [args.format] * len(tasks),
+                              [args.batch_size] * len(tasks))
+            count = sum(counts)
+
+        if args.format == "csv":
+            CsvWriter(args.output, COLUMNS[args.report]).close()
+            with open(args.output, "ab") as output:
+                for path in paths:
+                    with open(path, "rb") as part:
+                        shutil.copyfileobj(part, output)
+        else:
+            writer = ParquetWriter(args.output, COLUMNS[args.report])
+            try:
+                for path in paths:
+                    writer.write_part(path)
+            finally:
+                writer.close()
+
+    print(f"{args.report}: {count} row(s) written to {args.output} in {time.perf_counter() - started:.2f}s "
+          f"({len(tasks)} task(s), {args.workers} worker(s)).")
+    return count
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Reports over the transaction ledger.")
+    parser.add_argument("report", choices=sorted(ROWS))
+    parser.add_argument("--output", required=True, help="File to write the report to.")
+    parser.add_argument("--format", choices=sorted(WRITERS), help="Output format (default: from the file extension).")
+    parser.add_argument("--start", help="First UTC day to include (YYYY-MM-DD, default: oldest transaction).")
+    parser.add_argument("--end", help="UTC day to stop before (YYYY-MM-DD, default: now).")
+    parser.add_argument("--workers", type=int, default=REPORT_WORKERS, help="Worker processes.")
+    parser.add_argument("--batch-size", type=int, default=REPORT_BATCH_SIZE, help="Cursor and write batch size.")
+    parser.add_argument("--limit", type=int, default=100, help="Depositors per currency (top-depositors).")
+    parser.add_argument("--mismatches-only", action="store_true", help="Only list differences (reconciliation).")
+    args = parser.parse_args(argv)
+    if args.format is None:
+        args.format = "parquet" if args.output.endswith(".parquet") else "csv"
+
+    run_report(args)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,84 @@
+import re
+
+
+class Route:
+    def __init__(self, name, handler, parser=None, flows=None, steps=None):
+        self.name = name
+        self.handler = handler
+        self.parser = parser
+        self.flows = frozenset(flows) if flows is not None else None
+        self.steps = frozenset(steps) if steps is not None else None
+
+    def allows(self, state):
+        if self.flows is not None and state.get("flow") not in self.flows:
+            return False
+        if self.steps is not None and state.get("step") not in self.steps:
+            return False
+        return True
+
+
+class Router:
+    """Transition table for the conversation.
+
+    Callback queries are resolved by exact callback data or, for data carrying
+    arguments (``<prefix>_<args>``), by prefix plus a precompiled parser. Text
+    messages are resolved by the (flow, step) of the conversation state. Every
+    lookup is a dict access, so adding flows does not slow dispatch down.
+    """
+
+    def __init__(self):
+        self._callbacks = {}
+        self._prefixed = {}
+        self._messages = {}
+
+    def callback(self, *data, flows=None, steps=None):
+        def register(handler):
+            for value in data:
+                if value in self._callbacks:
+                    raise ValueError(f"Callback '{value}' is already routed")
+                self._callbacks[value] = Route(value, handler, flows=flows, steps=steps)
+            return handler
+
+        return register
+
+    def callback_prefix(self, prefix, pattern, flows=None, steps=None):
+        parser = re.compile(pattern)
+
+        def register(handler):
+            if prefix in self._prefixed:
+                raise ValueError(f"Callback prefix '{prefix}' is already routed")
+            self._prefixed[prefix] = Route(prefix, handler, parser, flows, steps)
+            return handler
+
+        return register
+
+    def message(self, flow, step):
+        def register(handler):
+            if (flow, step) in self._messages:
+                raise ValueError(f"Messages in {flow} step {step} are already routed")
+            self._messages[(flow, step)] = Route(f"{flow}:{step}", handler)
+            return handler
+
+        return register
+
+    def resolve_callback(self, data):
+        if not data:
+            return None, ()
+        route = self._callbacks.get(data)
+        if route is not None:
+            return route, ()
+
+        separator = data.find("_")
+        while separator != -1:
+            route = self._prefixed.get(data[:separator])
+            if route is not None:
+                match = route.parser.fullmatch(data)
+                return (route, match.groups()) if match else (None, ())
+            separator = data.find("_", separator + 1)
+        return None, ()
+
+    def resolve_message(self, state):
+        return self._messages.get((state.get("flow"), state.get("step")))
+
+    def routes(self):
+        return list(self._callbacks.values()) + list(self._prefixed.values()) + list(self._messages.values())
@@ -0,0 +1,137 @@
+import asyncio
+import os
+import time
+from collections import OrderedDict
+
+import async_database
+
+STATE_CACHE_SIZE = int(os.getenv("STATE_CACHE_SIZE", "10000"))
+STATE_CACHE_TTL = float(os.getenv("STATE_CACHE_TTL", "900"))
+STATE_FLUSH_INTERVAL = float(os.getenv("STATE_FLUSH_INTERVAL", "0.5"))
+
+
+class StateStore:
+    """Bounded LRU cache of conversation states with write-behind to MongoDB.
+
+    Reads are served from memory and only fall back to MongoDB on a miss or
+    after the TTL expires. Writes are diffed against the cached state and the
+    changed fields are coalesced per user until the next background flush.
+    """
+
+    def __init__(self, max_size=STATE_CACHE_SIZE, ttl=STATE_CACHE_TTL, flush_interval=STATE_FLUSH_INTERVAL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self._entries = OrderedDict()
+        self._pending = {}
+        self._flushing = set()
+        self._flush_task = None
+
+    async def get(self, user_id):
+        entry = self._entries.get(user_id)
+        if entry and entry[1] > time.monotonic():
+            self._entries.move_to_end(user_id)
+            return dict(entry[0])
+
+        if user_id in self._pending:
+            await self._flush_user(user_id, self._pending.pop(user_id))
+        state = await async_database.get_user_state(user_id) or {}
+        self._remember(user_id, state)
+        return dict(state)
+
+    def put(self, user_id, state):
+        entry = self._entries.get(user_id)
+        previous = entry[0] if entry else {}
+        pending = self._pending.setdefault(user_id, {"replace": None, "set": {}, "unset": set()})
+
+        if pending["replace"] is not None or entry is None:
+            pending["replace"] = dict(state)
+        else:
+            for key, value in state.items():
+                if key not in previous or previous[key] != value:
+                    pending["set"][key] = value
+                    pending["unset"].discard(key)
+            for key in previous.keys() - state.keys():
+                pending["unset"].add(key)
+                pending["set"].pop(key, None)
+
+        self._remember(user_id, state)
+
+    def clear(self, user_id):
+        self._pending[user_id] = {"replace": {}, "set": {}, "unset": set()}
+        self._remember(user_id, {})
+
+    def forget(self, user_id):
+        """Marks the state as cleared when the reset was already written by the caller.
+
+        Falls back to clear() while an earlier write of the state is still in
+        flight, since that write could land after the caller's reset.
+        """
+        if user_id in self._flushing:
+            self.clear(user_id)
+            return
+        self._pending.pop(user_id, None)
+        self._remember(user_id, {})
+
+    def invalidate(self, user_id):
+        self._entries.pop(user_id, None)
+
+    def invalidate_all(self):
+        self._entries.clear()
+
+    def _remember(self, user_id, state):
+        self._entries[user_id] = (dict(state), time.monotonic() + self.ttl)
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    async def _flush_user(self, user_id, pending):
+        self._flushing.add(user_id)
+        try:
+            await self._write_user(user_id, pending)
+        finally:
+            self._flushing.discard(user_id)
+
+    async def _write_user(self, user_id, pending):
+        if pending["replace"] is not None:
+            if pending["replace"]:
+                await async_database.update_user(user_id, {"state": pending["replace"]})
+            else:
+                await async_database.update_user(user_id, {"$unset": {"state": ""}})
+            return
+
+        update = {f"state.{key}": value for key, value in pending["set"].items()}
+        if pending["unset"]:
+            update["$unset"] = {f"state.{key}": "" for key in pending["unset"]}
+        if update:
+            await async_database.update_user(user_id, update)
+
+    async def flush(self):
+        pending, self._pending = self._pending, {}
+        if pending:
+            await asyncio.gather(*(self._flush_user(user_id, item) for user_id, item in pending.items()))
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"Error flushing conversation states: {e}")
+
+    def start(self):
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def close(self):
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+            self._flush_task = None
+        await self.flush()
+
+
+state_store = StateStore()
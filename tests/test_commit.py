@@ -0,0 +1,117 @@
+import os
+import sys
+import threading
+import unittest
+from decimal import Decimal
+from unittest import mock
+
+import mongomock
+from pymongo import errors
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database  # noqa: E402
+import money  # noqa: E402
+
+
+def deposit(user_id, amount, key):
+    unit = database.UnitOfWork(user_id)
+    unit.add_transaction("deposit", "paypal", "USD", Decimal(amount), key)
+    unit.clear_state()
+    return unit
+
+
+def fail_after(method):
+    """Runs `method` and then raises, as when the server applied a write but the reply was lost."""
+    def wrapper(*args, **kwargs):
+        method(*args, **kwargs)
+        raise errors.AutoReconnect("connection closed")
+    return wrapper
+
+
+class CommitTest(unittest.TestCase):
+    def setUp(self):
+        db = mongomock.MongoClient()["bot_database"]
+        self.users = db["users"]
+        self.transactions = db["transactions"]
+        self.users.create_index("user_id", unique=True)
+        self.transactions.create_index("idempotency_key", unique=True, sparse=True)
+        for name, collection in [("users_collection", self.users), ("transactions_collection", self.transactions)]:
+            patcher = mock.patch.object(database, name, collection)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.users.insert_one({"user_id": 1, "state": {"flow": "deposit"}})
+
+    def balance(self, user_id=1):
+        user = self.users.find_one({"user_id": user_id}) or {}
+        return user.get("balances", {}).get("paypal", {}).get("USD", 0)
+
+    def test_commit_credits_once(self):
+        self.assertEqual(database._commit_units([deposit(1, "5", "k")]), [[True]])
+        self.assertEqual(database._commit_units([deposit(1, "5", "k")]), [[False]])
+        self.assertEqual(self.balance(), 500)
+        self.assertEqual(self.transactions.count_documents({}), 1)
+        self.assertTrue(database.is_processed(1, "k"))
+        self.assertIn("balances_updated_at", self.users.find_one({"user_id": 1}))
+
+    def test_retry_after_rows_landed_without_reply(self):
+        with mock.patch.object(self.transactions, "insert_many", fail_after(self.transactions.insert_many)):
+            with self.assertRaises(errors.AutoReconnect):
+                database._commit_units([deposit(1, "5", "k")])
+        self.assertEqual(self.balance(), 0)
+        self.assertFalse(database.is_processed(1, "k"))
+
+        self.assertEqual(database._commit_units([deposit(1, "5", "k")]), [[True]])
+        self.assertEqual(self.balance(), 500)
+        self.assertEqual(self.transactions.count_documents({}), 1)
+
+    def test_retry_after_credit_landed_without_reply(self):
+        with mock.patch.object(self.users, "bulk_write", fail_after(self.users.bulk_write)):
+            with self.assertRaises(errors.AutoReconnect):
+                database._commit_units([deposit(1, "5", "k")])
+        self.assertTrue(database.is_processed(1, "k"))
+
+        self.assertEqual(database._commit_units([deposit(1, "5", "k")]), [[False]])
+        self.assertEqual(self.balance(), 500)
+        self.assertEqual(self.transactions.count_documents({}), 1)
+
+    def test_commit_reports_failure(self):
+        with mock.patch.object(self.users, "bulk_write", side_effect=errors.AutoReconnect("down")):
+            self.assertEqual(database.commit(deposit(1, "5", "k")), [False])
+        self.assertFalse(database.is_processed(1, "k"))
+        self.assertEqual(self.transactions.count_documents({}), 1)
+
+    def test_amount_too_large_is_rejected_before_batching(self):
+        unit = deposit(1, "5", "k")
+        unit.transactions[0]["amount_minor"] = money.MAX_MINOR + 1
+        with self.assertRaises(money.CurrencyError):
+            database.commit(unit)
+
+    def test_bad_unit_does_not_fail_its_batch(self):
+        bad = deposit(2, "1", "bad")
+        bad.transactions[0]["amount_minor"] = 2 ** 70
+        units = {"a": deposit(3, "1", "a"), "bad": bad, "b": deposit(4, "2", "b")}
+        committer = database.GroupCommitter(window=0.5, max_batch=len(units))
+        results = {}
+
+        def run(name):
+            try:
+                results[name] = committer.commit(units[name])
+            except Exception as e:
+                results[name] = e
+
+        threads = [threading.Thread(target=run, args=(name,)) for name in units]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(results["a"], [True])
+        self.assertEqual(results["b"], [True])
+        self.assertIsInstance(results["bad"], OverflowError)
+        self.assertEqual(self.balance(3), 100)
+        self.assertEqual(self.balance(4), 200)
+
+
+if __name__ == '__main__':
+    unittest.main()